@@ -1,13 +1,19 @@
 import posixpath
 from django import forms
 from django.contrib import admin
+from django.contrib.admin import helpers
+from django.contrib.sites.models import Site
 from django.core.exceptions import ImproperlyConfigured
+from django.template.response import TemplateResponse
 from django.utils.translation import ungettext, ugettext_lazy as _
 from django.utils.safestring import mark_safe
 
 from dbtemplates.conf import settings
-from dbtemplates.models import (Template,
-    remove_cached_template, add_template_to_cache)
+from dbtemplates.models import (Template, refresh_cached_templates,
+    add_templates_to_sites, remove_templates_from_sites, get_dependents,
+    defer_cache_updates)
+from dbtemplates.utils.cache import (remove_cached_templates,
+                                     invalidate_cached_templates)
 from dbtemplates.utils.template import check_template_syntax
 
 # Check if django-reversion is installed and use reversions' VersionAdmin
@@ -82,6 +88,15 @@ class TemplateAdminForm(forms.ModelForm):
         exclude = ()
 
 
+class TemplateSitesForm(forms.Form):
+    """
+    Form of the intermediate page of the bulk site assignment actions.
+    """
+    sites = forms.ModelMultipleChoiceField(
+        queryset=Site.objects.all(), label=_('sites'),
+        widget=forms.CheckboxSelectMultiple)
+
+
 class TemplateAdmin(TemplateModelAdmin):
     form = TemplateAdminForm
     fieldsets = (
@@ -90,7 +105,7 @@ class TemplateAdmin(TemplateModelAdmin):
             'classes': ('monospace',),
         }),
         (_('Advanced'), {
-            'fields': (('sites'),),
+            'fields': (('sites'), 'used_by'),
         }),
         (_('Date/time'), {
             'fields': (('creation_date', 'last_changed'),),
@@ -99,16 +114,28 @@ class TemplateAdmin(TemplateModelAdmin):
     )
     filter_horizontal = ('sites',)
     list_display = ('name', 'creation_date', 'last_changed', 'site_list')
-    readonly_fields = ('creation_date', 'last_changed')
+    readonly_fields = ('creation_date', 'last_changed', 'used_by')
     list_filter = ('sites',)
     save_as = True
     search_fields = ('name', 'content')
-    actions = ['invalidate_cache', 'repopulate_cache', 'check_syntax']
+    actions = ['invalidate_cache', 'invalidate_all_cache', 'repopulate_cache',
+               'check_syntax', 'add_to_sites', 'remove_from_sites']
+    change_sites_template = 'admin/dbtemplates/template/change_sites.html'
+
+    def changeform_view(self, *args, **kwargs):
+        # updates the cache once per template after the transaction of
+        # the form, its inlines and the sites
+        with defer_cache_updates():
+            return super(TemplateAdmin, self).changeform_view(*args, **kwargs)
+
+    def delete_view(self, *args, **kwargs):
+        with defer_cache_updates():
+            return super(TemplateAdmin, self).delete_view(*args, **kwargs)
 
     def invalidate_cache(self, request, queryset):
-        for template in queryset:
-            remove_cached_template(template)
-        count = queryset.count()
+        names = list(queryset.values_list('name', flat=True))
+        remove_cached_templates(names)
+        count = len(names)
         message = ungettext(
             "Cache of one template successfully invalidated.",
             "Cache of %(count)d templates successfully invalidated.",
@@ -117,10 +144,16 @@ class TemplateAdmin(TemplateModelAdmin):
     invalidate_cache.short_description = _("Invalidate cache of "
                                            "selected templates")
 
+    def invalidate_all_cache(self, request, queryset):
+        invalidate_cached_templates()
+        self.message_user(request, _("Cache of all templates successfully "
+                                     "invalidated."))
+    invalidate_all_cache.short_description = _("Invalidate cache of "
+                                               "all templates")
+
     def repopulate_cache(self, request, queryset):
-        for template in queryset:
-            add_template_to_cache(template)
-        count = queryset.count()
+        count = refresh_cached_templates(
+            queryset.values_list('pk', flat=True))
         message = ungettext(
             "Cache successfully repopulated with one template.",
             "Cache successfully repopulated with %(count)d templates.",
@@ -151,8 +184,65 @@ class TemplateAdmin(TemplateModelAdmin):
             self.message_user(request, message % {'count': count})
     check_syntax.short_description = _("Check template syntax")
 
+    def add_to_sites(self, request, queryset):
+        return self.change_sites(
+            request, queryset, 'add_to_sites', add_templates_to_sites,
+            _("Add the selected templates to the following sites:"),
+            ungettext("One template successfully added to %(sites)s.",
+                      "%(count)d templates successfully added to %(sites)s.",
+                      queryset.count()))
+    add_to_sites.short_description = _("Add selected templates to sites")
+
+    def remove_from_sites(self, request, queryset):
+        return self.change_sites(
+            request, queryset, 'remove_from_sites',
+            remove_templates_from_sites,
+            _("Remove the selected templates from the following sites:"),
+            ungettext("One template successfully removed from %(sites)s.",
+                      "%(count)d templates successfully removed "
+                      "from %(sites)s.", queryset.count()))
+    remove_from_sites.short_description = _("Remove selected templates "
+                                            "from sites")
+
+    def change_sites(self, request, queryset, action, change, description,
+                     message):
+        """
+        Shows an intermediate page to choose the sites and applies the
+        change to all selected templates at once.
+        """
+        if request.POST.get('apply'):
+            form = TemplateSitesForm(request.POST)
+            if form.is_valid():
+                sites = form.cleaned_data['sites']
+                count = change(queryset.values_list('pk', flat=True),
+                               [site.pk for site in sites])
+                self.message_user(request, message % {
+                    'count': count,
+                    'sites': ', '.join([site.name for site in sites]),
+                })
+                return None
+        else:
+            form = TemplateSitesForm()
+        context = dict(
+            self.admin_site.each_context(request),
+            title=getattr(self, action).short_description,
+            description=description,
+            form=form,
+            selected=list(queryset.values_list('pk', flat=True)),
+            opts=self.model._meta,
+            action=action,
+            action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+        )
+        return TemplateResponse(request, self.change_sites_template, context)
+
     def site_list(self, template):
         return ", ".join([site.name for site in template.sites.all()])
     site_list.short_description = _('sites')
 
+    def used_by(self, template):
+        if template.pk is None:
+            return ''
+        return ", ".join(sorted(get_dependents(template.name)))
+    used_by.short_description = _('used by')
+
 admin.site.register(Template, TemplateAdmin)
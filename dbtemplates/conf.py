@@ -16,6 +16,27 @@ class DbTemplatesConf(AppConf):
     MEDIA_PREFIX = None
     CACHE_BACKEND = None
     CACHE_TIMEOUT = datetime.timedelta(days=7).total_seconds()
+    CACHE_TIMEOUT_JITTER = 0
+    CACHE_SOFT_TIMEOUT = 0
+    CACHE_COMPRESS_MIN_SIZE = 0
+    CACHE_CHUNK_SIZE = 0
+    REFRESH_WORKERS = 2
+    REFRESH_QUEUE_SIZE = 100
+    CACHE_LOCK_TIMEOUT = 0
+    CACHE_LOCK_WAIT = 0.5
+    LOCAL_CACHE_SIZE = 0
+    LOCAL_CACHE_CHECK_INTERVAL = 1
+    SNAPSHOT = False
+    SNAPSHOT_POLL_INTERVAL = 30
+    PREFETCH = False
+    RESOLUTION_TABLE = False
+    READ_DATABASE = None
+    METRICS = False
+    METRICS_PER_TEMPLATE = False
+    METRICS_CALLBACK = None
+    METRICS_PUBLISH_INTERVAL = 60
+    NEGATIVE_CACHE = False
+    NEGATIVE_CACHE_TIMEOUT = datetime.timedelta(minutes=5).total_seconds()
 
     def configure_media_prefix(self, value):
         if value is None:
@@ -49,3 +70,12 @@ class DbTemplatesConf(AppConf):
             raise ImproperlyConfigured("Please add 'tinymce' to your "
                 "INSTALLED_APPS setting to make use of it in dbtemplates.")
         return value
+
+    def configure(self):
+        # without the negative cache, prefetching queries the database for
+        # every included template that lives on the file system
+        if (self.configured_data['PREFETCH'] and
+                not self.configured_data['NEGATIVE_CACHE']):
+            raise ImproperlyConfigured("DBTEMPLATES_PREFETCH requires "
+                "DBTEMPLATES_NEGATIVE_CACHE to be enabled.")
+        return self.configured_data
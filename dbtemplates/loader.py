@@ -1,19 +1,33 @@
+import time
+
 from django.db import router
+from django.db.models import Q
 from django.template import TemplateDoesNotExist
-from django.contrib.sites.models import Site
+from django.utils import six
+from django.utils.encoding import force_bytes
+from django.utils.functional import lazy
 
-from dbtemplates.models import Template
+from dbtemplates.models import Template, TemplateResolution
 from dbtemplates.utils.cache import (
-    get_cache_key,
-    add_template_to_cache,
+    set_cached_template,
+    add_templates_to_cache,
     fetch_template_from_cache,
+    fetch_templates_from_cache,
+    add_missing_template_to_cache,
+    add_missing_templates_to_cache,
+    get_prefetched_templates,
+    compiled_template_caches,
+    template_lock,
     cache,
+    version_key,
 )
+from dbtemplates.conf import settings
+from dbtemplates.utils import stats
+from dbtemplates.utils.sites import get_current_site_id, get_site_domain
+from dbtemplates.utils.snapshot import snapshot
+from dbtemplates.utils.template import get_template_dependencies
 from django.template.loaders.base import Loader as BaseLoader
-
-
-def site_cache_permission_rule(current_site, cache_value):
-    return cache_value and current_site.pk in cache_value.get('sites')
+from django.template.loaders.cached import Loader as BaseCachedLoader
 
 
 class Loader(BaseLoader):
@@ -23,7 +37,34 @@ class Loader(BaseLoader):
     Tries to load the template from the dbtemplates cache backend specified
     by the DBTEMPLATES_CACHE_BACKEND setting. If it does not find a template
     it falls back to query the database field ``name`` with the template path
-    and ``sites`` with the current site.
+    and ``sites`` with the current site, which is the site of the request if
+    ``dbtemplates.middleware.CurrentSiteMiddleware`` is used.
+
+    If DBTEMPLATES_NEGATIVE_CACHE is enabled, templates not found in the
+    database are remembered per site, so that templates living on the file
+    system don't cost database queries on every lookup.
+
+    Templates soft-expired in the cache, see DBTEMPLATES_CACHE_SOFT_TIMEOUT,
+    are served from the cache while being refreshed in the background.
+
+    If DBTEMPLATES_SNAPSHOT is enabled, templates are looked up in an
+    in-process snapshot of all database templates instead.
+
+    Missing templates are loaded from the database by one thread at a time,
+    and by one process at a time if DBTEMPLATES_CACHE_LOCK_TIMEOUT is set.
+
+    If DBTEMPLATES_RESOLUTION_TABLE is enabled, templates are looked up in
+    the database by site and name in a denormalized table instead.
+
+    If DBTEMPLATES_READ_DATABASE is set, templates are read from that
+    database, falling back to the primary database for templates it
+    doesn't have yet.
+
+    If DBTEMPLATES_PREFETCH is enabled, the templates a loaded template
+    extends or includes are prefetched along with it.
+
+    If DBTEMPLATES_METRICS is enabled, the outcome and duration of every
+    lookup is recorded, see ``dbtemplates.utils.stats``.
     """
     is_usable = True
     display_format = 'dbtemplates:{origin}:{template_name}:{domain}'
@@ -40,52 +81,276 @@ class Loader(BaseLoader):
             domain=domain
         )
 
-    def fetch_template_from_db(self, template_name, **params):
-        templates = Template.objects.filter(
-            name__exact=template_name, **params).distinct()
-        if not templates:
+    def get_display_name(self, origin, template_name, site_id):
+        """
+        Returns the display name for the origin of a template, which looks
+        up the domain of the site only when it's used, i.e. when template
+        debugging is enabled.
+        """
+        return lazy_display_name(origin, template_name, site_id)
+
+    def fetch_template_from_db(self, template_name, site_id):
+        """
+        Returns the pk, content, site ids and database alias of the template
+        available on the site with the given id in a single query, preferring
+        a template assigned to the site over a template without any sites.
+        """
+        templates = self.fetch_templates_from_db([template_name], site_id)
+        if template_name not in templates:
             raise Template.DoesNotExist(template_name)
-        # template names are unique => there should always be a single
-        # template returned
-        template = templates[0]
-        return template
-
-    def load_and_store_template(self, template_name, key, site, **params):
-        template = self.fetch_template_from_db(template_name, **params)
-        add_template_to_cache(template)
-        db = router.db_for_read(Template, instance=template)
-        display_name = self.make_display_name(db, template_name, site.domain)
-        template_content = template.content
-        return template_content, display_name
-
-    def load_from_cache(self, site, template_name):
+        return templates[template_name]
+
+    def fetch_templates_from_db(self, template_names, site_id):
+        """
+        Returns a dict mapping the names of the given templates available
+        on the site with the given id to their pk, content, site ids and the
+        alias of the database they were read from, using a single query.
+        """
+        template_names = list(template_names)
+        if settings.DBTEMPLATES_RESOLUTION_TABLE:
+            fetch = self.fetch_resolved_templates
+        else:
+            fetch = self.fetch_templates
+        start = time.time()
+        replica = settings.DBTEMPLATES_READ_DATABASE
+        using = replica or router.db_for_read(Template)
+        templates = dict(
+            (name, template + (using,))
+            for name, template in fetch(template_names, site_id,
+                                        using).items())
+        misses = [name for name in template_names if name not in templates]
+        primary = router.db_for_write(Template)
+        if replica and misses and replica != primary:
+            # the replica may lag behind, e.g. right after a template was
+            # saved, so only a miss on the primary database is final
+            for name in misses:
+                stats.incr('replica_misses', site_id, name)
+            templates.update(
+                (name, template + (primary,))
+                for name, template in fetch(misses, site_id, primary).items())
+        stats.timing('db_time', time.time() - start, site_id,
+                     template_names[0] if len(template_names) == 1 else None)
+        for name in template_names:
+            stats.incr('db_hits' if name in templates else 'db_misses',
+                       site_id, name)
+        return templates
+
+    def fetch_resolved_templates(self, template_names, site_id, using=None):
+        """
+        Looks the given templates up in the resolution table, see
+        DBTEMPLATES_RESOLUTION_TABLE. Their cached contents only apply to
+        the given site.
+        """
+        rows = TemplateResolution.objects.db_manager(using).filter(
+            site=site_id, name__in=template_names).values_list(
+            'template_id', 'name', 'content')
+        return dict((name, (pk, content, set([site_id])))
+                    for pk, name, content in rows)
+
+    def fetch_templates(self, template_names, site_id, using=None):
+        """
+        Looks the given templates up by name, joining only the given site so
+        that each template comes back at most once. Their cached contents
+        only apply to the given site, unless they don't have any sites.
+        """
+        rows = Template.objects.db_manager(using).filter(
+            Q(sites=site_id) | Q(sites__isnull=True),
+            name__in=template_names).values_list(
+            'pk', 'name', 'content', 'sites')
+        templates = {}
+        for pk, name, content, row_site_id in rows:
+            if row_site_id is not None:
+                templates[name] = pk, content, set([row_site_id])
+            else:
+                templates.setdefault(name, (pk, content, set()))
+        return templates
+
+    def load_and_store_template(self, template_name, site_id):
+        pk, content, sites, using = self.fetch_template_from_db(
+            template_name, site_id)
+        set_cached_template(template_name, content, sites)
+        display_name = self.get_display_name(using, template_name, site_id)
+        return content, display_name
+
+    def load_from_cache(self, site_id, template_name):
         source = fetch_template_from_cache(
-            template_name,
-            lambda cached: site_cache_permission_rule(site, cached)
-        )
-        if source:
-            display_name = self.make_display_name(
-                'cache',
-                template_name,
-                site.domain
-            )
+            template_name, site_id,
+            lambda: self.load_and_store_template(template_name, site_id))
+        if source is not None:
+            display_name = self.get_display_name('cache', template_name,
+                                                 site_id)
             return source, display_name
 
+    def load_from_snapshot(self, site_id, template_name):
+        source = snapshot.get(template_name, site_id)
+        if source is None:
+            stats.incr('snapshot_misses', site_id, template_name)
+            raise TemplateDoesNotExist(template_name)
+        stats.incr('snapshot_hits', site_id, template_name)
+        display_name = self.get_display_name('snapshot', template_name,
+                                             site_id)
+        return source, display_name
+
+    def load_from_prefetched(self, site_id, template_name):
+        content, expires = get_prefetched_templates().get(
+            (site_id, template_name), (None, None))
+        if expires is None or expires < time.time():
+            return None
+        stats.incr('prefetch_hits', site_id, template_name)
+        if content is None:
+            raise TemplateDoesNotExist(template_name)
+        display_name = self.get_display_name('prefetch', template_name,
+                                             site_id)
+        return content, display_name
+
+    def load_template_sources(self, template_names, site_id=None):
+        """
+        Returns a dict mapping the names of the given templates available on
+        the given or current site to their contents, with a single cache
+        call and a single query for the templates that aren't cached, e.g.
+        to resolve the templates of a whole page at once.
+        """
+        if site_id is None:
+            site_id = get_current_site_id()
+        template_names = list(template_names)
+        found, missing = fetch_templates_from_cache(
+            template_names, site_id,
+            lambda name: lambda: self.load_and_store_template(name, site_id))
+        misses = [name for name in template_names
+                  if name not in found and name not in missing]
+        if misses:
+            fetched = self.fetch_templates_from_db(misses, site_id)
+            add_templates_to_cache(
+                (name, content, sites)
+                for name, (pk, content, sites, using) in fetched.items())
+            add_missing_templates_to_cache(
+                [name for name in misses if name not in fetched], site_id)
+            found.update((name, content) for name, (pk, content, sites,
+                                                    using) in fetched.items())
+        return found
+
+    def prefetch(self, site_id, content):
+        """
+        Loads the templates the given template content extends or includes,
+        and in turn the templates those extend or include, for use by the
+        current thread during DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL seconds.
+
+        Costs a single cache call, and a single query for the templates that
+        aren't cached, per level of nesting.
+        """
+        now = time.time()
+        templates = get_prefetched_templates()
+        for key, (value, expires) in list(templates.items()):
+            if expires < now:
+                del templates[key]
+        expires = now + settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL
+        contents, seen = [content], set()
+        while contents:
+            names = set(name for content in contents
+                        for kind, name in get_template_dependencies(content))
+            names = [name for name in names if name not in seen and
+                     (site_id, name) not in templates]
+            if not names:
+                break
+            seen.update(names)
+            found = self.load_template_sources(names, site_id)
+            for name in names:
+                templates[(site_id, name)] = found.get(name), expires
+            contents = list(found.values())
+
     def load_template_source(self, template_name, template_dirs=None):
-        site = Site.objects.get_current()
-        cache_tuple = self.load_from_cache(site, template_name)
+        site_id = get_current_site_id()
+        if not settings.DBTEMPLATES_METRICS:
+            return self.load_source(site_id, template_name)
+        start = time.time()
+        try:
+            source, display_name = self.load_source(site_id, template_name)
+        except TemplateDoesNotExist:
+            stats.timing('load_time', time.time() - start, site_id,
+                         template_name)
+            raise
+        stats.timing('load_time', time.time() - start, site_id, template_name)
+        stats.incr('bytes_served', site_id, template_name,
+                   len(force_bytes(source)))
+        return source, display_name
+
+    def load_source(self, site_id, template_name):
+        if settings.DBTEMPLATES_SNAPSHOT:
+            return self.load_from_snapshot(site_id, template_name)
+        if not settings.DBTEMPLATES_PREFETCH:
+            return self.load_from_cache_or_db(site_id, template_name)
+        prefetched_tuple = self.load_from_prefetched(site_id, template_name)
+        if prefetched_tuple:
+            return prefetched_tuple
+        source, display_name = self.load_from_cache_or_db(site_id,
+                                                          template_name)
+        self.prefetch(site_id, source)
+        return source, display_name
+
+    def load_from_cache_or_db(self, site_id, template_name):
+        cache_tuple = self.load_from_cache(site_id, template_name)
         if cache_tuple:
             return cache_tuple
 
-        cache_key = get_cache_key(template_name)
-        try:
-            return self.load_and_store_template(template_name, cache_key,
-                                                site, sites__in=[site.id])
-        except (Template.MultipleObjectsReturned, Template.DoesNotExist):
+        with template_lock(template_name, site_id) as waited:
+            if waited:
+                cache_tuple = self.load_from_cache(site_id, template_name)
+                if cache_tuple:
+                    return cache_tuple
             try:
-                return self.load_and_store_template(template_name, cache_key,
-                                                    site, sites__isnull=True)
-            except (Template.MultipleObjectsReturned, Template.DoesNotExist):
+                return self.load_and_store_template(template_name, site_id)
+            except Template.DoesNotExist:
                 pass
+            add_missing_template_to_cache(template_name, site_id)
 
         raise TemplateDoesNotExist(template_name)
+
+
+lazy_display_name = lazy(
+    lambda origin, template_name, site_id: Loader.make_display_name(
+        origin, template_name, get_site_domain(site_id)), six.text_type)
+
+
+class CachedLoader(BaseCachedLoader):
+    """
+    A replacement for Django's cached template loader, to be wrapped around
+    ``dbtemplates.loader.Loader`` and other loaders.
+
+    Compiled templates are kept per site and dropped when a template with
+    the same name is changed in the database, right away in this process
+    via Django's signals and in all other processes once the version in
+    the cache backend is seen to change, at most every
+    DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL seconds.
+    """
+    def __init__(self, engine, loaders):
+        super(CachedLoader, self).__init__(engine, loaders)
+        self.version = None
+        self.checked = None
+        compiled_template_caches.add(self)
+
+    def cache_key(self, template_name, template_dirs):
+        key = super(CachedLoader, self).cache_key(template_name,
+                                                  template_dirs)
+        return get_current_site_id(), template_name, key
+
+    def validate(self):
+        now = time.time()
+        interval = settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL
+        if self.checked is not None and now - self.checked < interval:
+            return
+        version = cache.get(version_key)
+        self.checked = now
+        if version != self.version:
+            self.reset()
+            self.version = version
+
+    def load_template(self, template_name, template_dirs=None):
+        self.validate()
+        return super(CachedLoader, self).load_template(template_name,
+                                                       template_dirs)
+
+    def remove_template(self, template_name):
+        for compiled_cache in (self.template_cache, self.find_template_cache):
+            for key in list(compiled_cache):
+                if key[1] == template_name:
+                    compiled_cache.pop(key, None)
@@ -0,0 +1,14 @@
+from django.contrib.sites.models import Site
+from django.core.management.base import CommandError
+
+
+def get_site(value):
+    """
+    Returns the site with the given id or domain for command line options.
+    """
+    try:
+        if value.isdigit():
+            return Site.objects.get(pk=value)
+        return Site.objects.get(domain=value)
+    except Site.DoesNotExist:
+        raise CommandError("Site '%s' does not exist." % value)
@@ -1,21 +1,95 @@
+import os
+from itertools import islice
+from multiprocessing import Pool
+from optparse import make_option
+
 from django.core.management.base import CommandError, NoArgsCommand
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
 
 from dbtemplates.models import Template
-from dbtemplates.utils.template import check_template_syntax
+from dbtemplates.utils.template import check_template_source
+
+BATCH_SIZE = 100
 
 
 class Command(NoArgsCommand):
     help = "Ensures templates stored in the database don't have syntax errors."
+    option_list = NoArgsCommand.option_list + (
+        make_option("-j", "--jobs", action="store", dest="jobs", type="int",
+            default=1, help="number of processes compiling the templates "
+                            "[default: %default]"),
+        make_option("--since", action="store", dest="since", default=None,
+            help="only check templates changed since the given ISO 8601 "
+                 "date and time"),
+        make_option("--watermark", action="store", dest="watermark",
+            default=None, help="file storing the time of the last "
+                               "successful check; only templates changed "
+                               "since then are checked"))
 
     def handle_noargs(self, **options):
+        jobs = max(options.get('jobs') or 1, 1)
+        watermark = options.get('watermark')
+        since = options.get('since')
+        if since is None and watermark and os.path.exists(watermark):
+            with open(watermark) as f:
+                since = f.read().strip()
+        if since is not None:
+            since = self.parse_since(since)
+        started = now()
+
+        templates = Template.objects.all()
+        if since is not None:
+            templates = templates.filter(last_changed__gte=since)
+        pool = None
+        if jobs > 1:
+            # fork the workers before the query is running
+            pool = Pool(jobs)
         errors = []
-        for template in Template.objects.all():
-            valid, error = check_template_syntax(template)
-            if not valid:
-                errors.append('%s: %s' % (template.name, error))
+        try:
+            sources = templates.values_list('name', 'content').iterator()
+            if pool is None:
+                results = (check_template_source(source)
+                           for source in sources)
+            else:
+                results = self.imap(pool, sources, jobs * BATCH_SIZE)
+            for name, error in results:
+                if error is not None:
+                    errors.append('%s: %s' % (name, error))
+                    self.stderr.write(errors[-1])
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
         if errors:
             raise CommandError(
                 'Some templates contained errors\n%s' % '\n'.join(errors))
+        if watermark:
+            with open(watermark, 'w') as f:
+                f.write(started.isoformat())
         # NOTE: printing instead of using self.stdout.write to maintain
         # Django 1.2 compatibility
         print('OK')
+
+    def imap(self, pool, sources, size):
+        """
+        Checks the given sources in the pool, in batches read by the
+        current thread, since the pool's own threads can't share its
+        database connection.
+        """
+        while True:
+            batch = list(islice(sources, size))
+            if not batch:
+                break
+            for result in pool.imap_unordered(check_template_source, batch,
+                                              chunksize=20):
+                yield result
+
+    def parse_since(self, value):
+        try:
+            since = parse_datetime(value)
+        except ValueError:
+            since = None
+        if since is None:
+            raise CommandError("'%s' is not a valid date and time." % value)
+        return since
@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from dbtemplates.management.base import get_site
+from dbtemplates.utils.cache import invalidate_cached_templates
+
+
+class Command(NoArgsCommand):
+    help = "Makes all cached templates stale at once."
+    option_list = NoArgsCommand.option_list + (
+        make_option("-s", "--site", dest="site", default=None,
+            help="only invalidate the templates of the site with the given "
+                 "id or domain"),)
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options.get('site'):
+            site = get_site(options['site'])
+            invalidate_cached_templates(site.pk)
+            if verbosity >= 1:
+                self.stdout.write("Invalidated the cached templates "
+                                  "of %s." % site.domain)
+        else:
+            invalidate_cached_templates()
+            if verbosity >= 1:
+                self.stdout.write("Invalidated all cached templates.")
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.contrib.sites.models import Site
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import transaction
+
+from dbtemplates.models import (Template, TemplateResolution,
+                                set_template_resolutions)
+
+
+class Command(NoArgsCommand):
+    help = ("Rebuilds the table the template loader resolves templates with, "
+            "see DBTEMPLATES_RESOLUTION_TABLE.")
+    option_list = NoArgsCommand.option_list + (
+        make_option("-b", "--batch-size", dest="batch_size", type="int",
+            default=500, help="number of templates written at once "
+                              "[default: %default]"),)
+
+    def handle_noargs(self, **options):
+        batch_size = options.get('batch_size')
+        verbosity = int(options.get('verbosity', 1))
+        if batch_size < 1:
+            raise CommandError("The batch size must be a positive number.")
+
+        site_ids = list(Site.objects.values_list('pk', flat=True))
+        template_ids = list(Template.objects.values_list('pk', flat=True))
+        count = 0
+        with transaction.atomic():
+            TemplateResolution.objects.all().delete()
+            for index in range(0, len(template_ids), batch_size):
+                count += set_template_resolutions(
+                    template_ids[index:index + batch_size], site_ids)
+
+        if verbosity >= 1:
+            self.stdout.write("Resolved %d templates to %d site and name "
+                              "pairs." % (len(template_ids), count))
@@ -1,17 +1,53 @@
 import os
 import codecs
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 
 from django.contrib.sites.models import Site
 from django.core.management.base import CommandError, NoArgsCommand
+from django.db import transaction
+from django.db.models import Case, TextField, Value, When
 
 from django.template import Engine
 from django.template.utils import get_app_template_dirs
+from django.utils.encoding import force_bytes, force_text
+from django.utils.timezone import now
 
 from dbtemplates.conf import settings
-from dbtemplates.models import Template
+from dbtemplates.models import (Template, refresh_cached_templates,
+                                set_template_dependencies, touch_templates,
+                                update_template_resolutions)
 
 ALWAYS_ASK, FILES_TO_DATABASE, DATABASE_TO_FILES = ('0', '1', '2')
+BATCH_SIZE = 500
+
+
+def batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def content_hash(content):
+    return hashlib.md5(force_bytes(content)).hexdigest()
+
+
+def read_template(path):
+    """
+    Returns the contents of the given template file and their hash, or
+    ``(None, None)`` if it doesn't exist.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None, None
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    return force_text(data), hashlib.md5(data).hexdigest()
 
 
 class Command(NoArgsCommand):
@@ -30,7 +66,17 @@ class Command(NoArgsCommand):
             default=False, help="look for templates in applications "
                                 "directories before project templates"),
         make_option("-d", "--delete", action="store_true", dest="delete",
-            default=False, help="Delete templates after syncing"))
+            default=False, help="Delete templates after syncing"),
+        make_option("-b", "--bulk", action="store_true", dest="bulk",
+            default=False, help="sync all templates at once in a single "
+                                "transaction, without asking; requires "
+                                "--overwrite 1 or 2"),
+        make_option("-j", "--jobs", action="store", dest="jobs", type="int",
+            default=4, help="number of threads reading and hashing template "
+                            "files when syncing in bulk [default: %default]"),
+        make_option("-n", "--dry-run", action="store_true", dest="dry_run",
+            default=False, help="only print the changes a bulk sync would "
+                                "make, one JSON object per line"))
 
     def handle_noargs(self, **options):
         extension = options.get('ext')
@@ -38,6 +84,15 @@ class Command(NoArgsCommand):
         overwrite = options.get('overwrite')
         app_first = options.get('app_first')
         delete = options.get('delete')
+        bulk = options.get('bulk')
+        self.jobs = max(options.get('jobs') or 1, 1)
+        self.dry_run = options.get('dry_run')
+
+        if bulk and overwrite not in (FILES_TO_DATABASE, DATABASE_TO_FILES):
+            raise CommandError("Syncing in bulk requires --overwrite to be "
+                               "'1' or '2'.")
+        if self.dry_run and not bulk:
+            raise CommandError("A dry run requires --bulk.")
 
         if not extension.startswith("."):
             extension = ".%s" % extension
@@ -56,6 +111,17 @@ class Command(NoArgsCommand):
             tpl_dirs = list(template_engine.dirs) + app_dirs
         templatedirs = [d for d in tpl_dirs if os.path.isdir(d)]
 
+        if bulk:
+            paths = {}
+            for templatedir in templatedirs:
+                for name, path in self.find_templates(templatedir, extension):
+                    paths.setdefault(name, path)
+            if overwrite == FILES_TO_DATABASE:
+                self.sync_to_database(paths, site, force, delete)
+            else:
+                self.sync_to_files(paths, delete)
+            return
+
         for templatedir in templatedirs:
             for dirpath, subdirs, filenames in os.walk(templatedir):
                 for f in [f for f in filenames
@@ -111,3 +177,147 @@ class Command(NoArgsCommand):
                                     if delete:
                                         t.delete()
                                 break
+
+    def find_templates(self, templatedir, extension):
+        """
+        Yields the names and paths of the templates in the given directory.
+        """
+        for dirpath, subdirs, filenames in os.walk(templatedir):
+            for f in [f for f in filenames
+                      if f.endswith(extension) and not f.startswith(".")]:
+                path = os.path.join(dirpath, f)
+                name = path.split(templatedir)[1]
+                if name.startswith('/'):
+                    name = name[1:]
+                yield name, path
+
+    def read_templates(self, paths):
+        """
+        Reads and hashes the given template files in a thread pool and
+        returns a dict mapping template names to ``(content, hash)``.
+        """
+        names = list(paths)
+        if self.jobs == 1 or len(names) < 2:
+            results = [read_template(paths[name]) for name in names]
+        else:
+            pool = ThreadPool(min(self.jobs, len(names)))
+            try:
+                results = pool.map(read_template,
+                                   [paths[name] for name in names])
+            finally:
+                pool.close()
+                pool.join()
+        return dict(zip(names, results))
+
+    def report(self, action, name, path):
+        self.stdout.write(json.dumps(
+            {'action': action, 'name': name, 'path': path}, sort_keys=True))
+
+    def sync_to_database(self, paths, site, force, delete):
+        """
+        Creates and updates the database templates and their recorded
+        dependencies from the given template files in a single transaction,
+        with bulk queries and without any signals, and refreshes their cache
+        entries once afterwards.
+
+        Only templates whose content hash differs from the file's, or that
+        aren't on the given site yet, are written and refreshed.
+        """
+        existing = dict((name, (pk, content_hash(content)))
+                        for pk, name, content in Template.objects.values_list(
+                            'pk', 'name', 'content'))
+        files = self.read_templates(dict(
+            (name, path) for name, path in paths.items()
+            if name in existing or force))
+        through = Template.sites.through
+        on_site = set(through.objects.filter(site=site).values_list(
+            'template_id', flat=True))
+        created = sorted(name for name in files if name not in existing)
+        changed = sorted(name for name in files if name in existing and
+                         existing[name][1] != files[name][1])
+        added = sorted(name for name in files if name in existing and
+                       existing[name][0] not in on_site)
+
+        if self.dry_run:
+            for name in created:
+                self.report('create', name, paths[name])
+            for name in sorted(set(changed) | set(added)):
+                self.report('update', name, paths[name])
+            if delete:
+                for name in sorted(files):
+                    self.report('delete', name, paths[name])
+            return
+
+        pks = []
+        if created or changed or added:
+            with transaction.atomic():
+                Template.objects.bulk_create([
+                    Template(name=name, content=files[name][0])
+                    for name in created], batch_size=BATCH_SIZE)
+                for batch in batches(changed):
+                    batch_pks = [existing[name][0] for name in batch]
+                    Template.objects.filter(pk__in=batch_pks).update(
+                        content=Case(*[When(pk=existing[name][0],
+                                            then=Value(files[name][0]))
+                                       for name in batch],
+                                     output_field=TextField()),
+                        last_changed=now())
+                ids = dict((name, existing[name][0]) for name in changed)
+                for batch in batches(created):
+                    ids.update((name, pk) for pk, name in
+                               Template.objects.filter(
+                                   name__in=batch).values_list('pk', 'name'))
+                pks = [existing[name][0] for name in added]
+                pks.extend(ids[name] for name in created)
+                through.objects.bulk_create([
+                    through(template_id=pk, site=site) for pk in pks],
+                    batch_size=BATCH_SIZE)
+                for batch in batches(ids):
+                    set_template_dependencies(
+                        (ids[name], files[name][0]) for name in batch)
+                for batch in batches(added):
+                    touch_templates(existing[name][0] for name in batch)
+                for batch in batches(set(pks).union(ids.values())):
+                    update_template_resolutions(batch)
+        pks = set(pks).union(existing[name][0] for name in changed)
+        for batch in batches(pks):
+            refresh_cached_templates(batch)
+        if delete:
+            for name in files:
+                try:
+                    os.remove(paths[name])
+                except OSError:
+                    raise CommandError(u"Couldn't delete %s" % paths[name])
+
+    def sync_to_files(self, paths, delete):
+        """
+        Overwrites the given template files with the contents of the
+        database templates of the same name, skipping files whose content
+        hash already matches.
+        """
+        templates = [(pk, name, content) for pk, name, content in
+                     Template.on_site.values_list('pk', 'name', 'content')
+                     if name in paths]
+        files = self.read_templates(dict(
+            (name, paths[name]) for pk, name, content in templates))
+        synced = []
+        for pk, name, content in sorted(templates, key=lambda t: t[1]):
+            synced.append(pk)
+            if files[name][1] == content_hash(content):
+                continue
+            if self.dry_run:
+                self.report('update', name, paths[name])
+                continue
+            f = codecs.open(paths[name], 'w', 'utf-8')
+            try:
+                f.write(content)
+            finally:
+                f.close()
+        if delete:
+            if self.dry_run:
+                for pk, name, content in sorted(templates,
+                                                key=lambda t: t[1]):
+                    self.report('delete', name, paths[name])
+                return
+            for batch in batches(synced):
+                Template.objects.filter(pk__in=batch).delete()
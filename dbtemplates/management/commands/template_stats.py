@@ -0,0 +1,64 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from dbtemplates.utils.stats import (get_percentile, get_published_stats,
+                                     merge_stats)
+
+
+class Command(NoArgsCommand):
+    help = ("Shows the template loader metrics published by all processes, "
+            "see DBTEMPLATES_METRICS.")
+    option_list = NoArgsCommand.option_list + (
+        make_option("-s", "--site", dest="site", type="int", default=None,
+            help="only show the metrics of the site with the given id"),
+        make_option("-t", "--template", dest="template", default=None,
+            help="only show the metrics of the template with the given "
+                 "name, see DBTEMPLATES_METRICS_PER_TEMPLATE"),
+        make_option("-j", "--json", action="store_true", dest="json",
+            default=False, help="print the metrics of each process as JSON"))
+
+    def handle_noargs(self, **options):
+        stats = get_published_stats()
+        if options.get('json'):
+            self.stdout.write(json.dumps(stats, sort_keys=True))
+            return
+        counters, timings = merge_stats(stats)
+        site, template = options.get('site'), options.get('template')
+
+        def included(key):
+            metric, site_id, template_name = key
+            return ((site is None or site_id == site) and
+                    (template is None or template_name == template))
+
+        self.stdout.write("%d process(es)" % len(stats))
+        for key in sorted(filter(included, counters), key=self.sort_key):
+            self.stdout.write("%s %d" % (self.label(key), counters[key]))
+        for key in sorted(filter(included, timings), key=self.sort_key):
+            count, total, histogram = timings[key]
+            self.stdout.write(
+                "%s count=%d avg=%.2fms p50<=%sms p95<=%sms p99<=%sms" % (
+                    self.label(key), count,
+                    total * 1000 / count if count else 0,
+                    self.format_bound(get_percentile(histogram, 50)),
+                    self.format_bound(get_percentile(histogram, 95)),
+                    self.format_bound(get_percentile(histogram, 99))))
+
+    def sort_key(self, key):
+        metric, site_id, template_name = key
+        return metric, site_id or 0, template_name or ''
+
+    def label(self, key):
+        metric, site_id, template_name = key
+        label = metric
+        if site_id is not None:
+            label += " site=%s" % site_id
+        if template_name is not None:
+            label += " template=%s" % template_name
+        return label
+
+    def format_bound(self, bound):
+        if bound is None:
+            return '-'
+        return '%g' % (bound * 1000)
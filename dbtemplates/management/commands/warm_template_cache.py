@@ -0,0 +1,71 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db.models import Q
+from django.utils.encoding import force_bytes
+
+from dbtemplates.management.base import get_site
+from dbtemplates.models import Template, get_template_sites
+from dbtemplates.utils.cache import add_templates_to_cache
+
+
+class Command(NoArgsCommand):
+    help = "Fills the cache with the templates stored in the database."
+    option_list = NoArgsCommand.option_list + (
+        make_option("-b", "--batch-size", dest="batch_size", type="int",
+            default=500, help="number of templates written to the cache "
+                              "at once [default: %default]"),
+        make_option("-s", "--site", dest="site", default=None,
+            help="only warm the templates available on the site with the "
+                 "given id or domain"),
+        make_option("-p", "--prefix", dest="prefix", default=None,
+            help="only warm the templates whose name starts with the "
+                 "given prefix"))
+
+    def handle_noargs(self, **options):
+        batch_size = options.get('batch_size')
+        verbosity = int(options.get('verbosity', 1))
+        if batch_size < 1:
+            raise CommandError("The batch size must be a positive number.")
+
+        templates = Template.objects.all()
+        if options.get('site'):
+            site = get_site(options['site'])
+            through = Template.sites.through.objects
+            templates = templates.filter(
+                Q(pk__in=through.filter(site=site).values('template_id')) |
+                ~Q(pk__in=through.values('template_id')))
+        if options.get('prefix'):
+            templates = templates.filter(name__startswith=options['prefix'])
+
+        start = time.time()
+        count = size = 0
+        batch = []
+        rows = templates.values_list('pk', 'name', 'content').iterator()
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                size += self.warm(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            size += self.warm(batch)
+            count += len(batch)
+        duration = time.time() - start
+
+        if verbosity >= 1:
+            self.stdout.write(
+                "Warmed the cache with %d templates (%d bytes) in %.2fs, "
+                "%.1f templates/s." % (count, size, duration,
+                                       count / duration if duration else 0))
+
+    def warm(self, batch):
+        """
+        Caches a batch of (pk, name, content) rows, fetching the site ids of
+        all of them with a single query. Returns the size of the contents.
+        """
+        sites = get_template_sites([pk for pk, name, content in batch])
+        add_templates_to_cache((name, content, sites[pk])
+                               for pk, name, content in batch)
+        return sum(len(force_bytes(content)) for pk, name, content in batch)
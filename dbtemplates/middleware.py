@@ -0,0 +1,21 @@
+from django.contrib.sites.shortcuts import get_current_site
+
+from dbtemplates.utils.sites import clear_current_site_id, set_current_site_id
+
+
+class CurrentSiteMiddleware(object):
+    """
+    Makes the template loader use the site of the request, i.e.
+    ``request.site`` if it's set by Django's ``CurrentSiteMiddleware``, or
+    the site matching the host of the request if SITE_ID isn't set, for the
+    rest of the request.
+    """
+    def process_request(self, request):
+        site = getattr(request, 'site', None)
+        if site is None:
+            site = get_current_site(request)
+        set_current_site_id(site.pk)
+
+    def process_response(self, request, response):
+        clear_current_site_id()
+        return response
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def remove_legacy_cached_templates(apps, schema_editor):
+    from dbtemplates.utils.cache import remove_legacy_cached_templates
+    Template = apps.get_model('dbtemplates', 'Template')
+    names = Template.objects.using(
+        schema_editor.connection.alias).values_list('name', flat=True)
+    remove_legacy_cached_templates(names.iterator())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbtemplates', '0002_auto_20150928_1109'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_legacy_cached_templates,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def add_template_dependencies(apps, schema_editor):
+    from dbtemplates.utils.template import get_template_dependencies
+    Template = apps.get_model('dbtemplates', 'Template')
+    TemplateDependency = apps.get_model('dbtemplates', 'TemplateDependency')
+    db_alias = schema_editor.connection.alias
+    templates = Template.objects.using(db_alias).values_list('pk', 'content')
+    TemplateDependency.objects.using(db_alias).bulk_create([
+        TemplateDependency(template_id=pk, kind=kind, name=name)
+        for pk, content in templates.iterator()
+        for kind, name in get_template_dependencies(content)],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbtemplates', '0003_retire_legacy_cache_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateDependency',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255, verbose_name='name', db_index=True)),
+                ('kind', models.CharField(max_length=7, verbose_name='kind', choices=[(b'extends', 'extends'), (b'include', 'includes')])),
+                ('template', models.ForeignKey(related_name='dependencies', verbose_name='template', to='dbtemplates.Template')),
+            ],
+            options={
+                'db_table': 'django_template_dependency',
+                'verbose_name': 'template dependency',
+                'verbose_name_plural': 'template dependencies',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='templatedependency',
+            unique_together=set([('template', 'name', 'kind')]),
+        ),
+        migrations.RunPython(add_template_dependencies,
+                             migrations.RunPython.noop),
+    ]
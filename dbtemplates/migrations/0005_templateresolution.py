@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0001_initial'),
+        ('dbtemplates', '0004_templatedependency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateResolution',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=100, verbose_name='name')),
+                ('content', models.TextField(verbose_name='content', blank=True)),
+                ('last_changed', models.DateTimeField(verbose_name='last changed')),
+                ('site', models.ForeignKey(verbose_name='site', to='sites.Site')),
+                ('template', models.ForeignKey(related_name='resolutions', verbose_name='template', to='dbtemplates.Template')),
+            ],
+            options={
+                'db_table': 'django_template_resolution',
+                'verbose_name': 'template resolution',
+                'verbose_name_plural': 'template resolutions',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='templateresolution',
+            unique_together=set([('site', 'name')]),
+        ),
+    ]
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
+
 from django.db import models
 from django.db.models import signals
 from django.template import TemplateDoesNotExist
@@ -9,10 +12,18 @@ from django.contrib.sites.managers import CurrentSiteManager
 
 from dbtemplates.conf import settings
 from dbtemplates.utils.cache import (
+    compiled_template_caches,
     add_template_to_cache,
+    add_templates_to_cache,
+    bump_cache_version,
     remove_cached_template,
+    remove_cached_templates,
+    remove_compiled_template,
+    remove_compiled_templates,
+    remove_missing_templates_from_cache,
 )
-from dbtemplates.utils.template import get_template_source
+from dbtemplates.utils.template import (get_template_dependencies,
+                                       get_template_source)
 
 try:
     from django.utils.timezone import now
@@ -20,6 +31,10 @@ except ImportError:
     from datetime import datetime
     now = datetime.now
 
+# cache updates of templates collected until the end of the
+# defer_cache_updates() block
+deferred = threading.local()
+
 
 class Template(models.Model):
     """
@@ -73,6 +88,272 @@ class Template(models.Model):
         super(Template, self).save(*args, **kwargs)
 
 
+class TemplateDependency(models.Model):
+    """
+    Records that a template extends or includes the template with the given
+    name, which doesn't need to be stored in the database.
+    """
+    EXTENDS = 'extends'
+    INCLUDE = 'include'
+    KIND_CHOICES = (
+        (EXTENDS, _('extends')),
+        (INCLUDE, _('includes')),
+    )
+    template = models.ForeignKey(Template, verbose_name=_('template'),
+                                 related_name='dependencies')
+    name = models.CharField(_('name'), max_length=255, db_index=True)
+    kind = models.CharField(_('kind'), max_length=7, choices=KIND_CHOICES)
+
+    class Meta:
+        db_table = 'django_template_dependency'
+        verbose_name = _('template dependency')
+        verbose_name_plural = _('template dependencies')
+        unique_together = ('template', 'name', 'kind')
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.template_id, self.kind, self.name)
+
+
+class TemplateResolution(models.Model):
+    """
+    The template used for a name on a site, with a copy of its content, so
+    that the template loader can look it up with a single index probe if
+    DBTEMPLATES_RESOLUTION_TABLE is enabled. Templates without any sites
+    have a row for every site.
+    """
+    site = models.ForeignKey(Site, verbose_name=_('site'))
+    name = models.CharField(_('name'), max_length=100)
+    template = models.ForeignKey(Template, verbose_name=_('template'),
+                                 related_name='resolutions')
+    content = models.TextField(_('content'), blank=True)
+    last_changed = models.DateTimeField(_('last changed'))
+
+    class Meta:
+        db_table = 'django_template_resolution'
+        verbose_name = _('template resolution')
+        verbose_name_plural = _('template resolutions')
+        unique_together = ('site', 'name')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.site_id, self.name)
+
+
+def get_template_sites(template_ids):
+    """
+    Returns a dict mapping the given template ids to lists of the ids of
+    their sites, using a single query.
+    """
+    sites = dict((template_id, []) for template_id in template_ids)
+    memberships = Template.sites.through.objects.filter(
+        template_id__in=list(sites)).values_list('template_id', 'site_id')
+    for template_id, site_id in memberships:
+        sites[template_id].append(site_id)
+    return sites
+
+
+def touch_templates(template_ids):
+    """
+    Updates the ``last_changed`` field of the given templates, e.g. after
+    their sites were changed, for the template snapshots of other processes,
+    if DBTEMPLATES_SNAPSHOT is enabled.
+    """
+    if settings.DBTEMPLATES_SNAPSHOT:
+        Template.objects.filter(pk__in=list(template_ids)).update(
+            last_changed=now())
+
+
+def refresh_cached_templates(template_ids):
+    """
+    Replaces the cached contents of the given templates with a single
+    query for their site ids and a single cache write.
+    """
+    rows = list(Template.objects.filter(pk__in=template_ids).values_list(
+        'pk', 'name', 'content'))
+    sites = get_template_sites([pk for pk, name, content in rows])
+    names = [name for pk, name, content in rows]
+    remove_cached_templates(names, bump_version=False)
+    add_templates_to_cache((name, content, sites[pk])
+                           for pk, name, content in rows)
+    remove_missing_templates_from_cache(names)
+    remove_compiled_templates(names)
+    # only now, so that other processes can't see them as missing
+    bump_cache_version()
+    return len(rows)
+
+
+def update_template_resolutions(template_ids):
+    """
+    Replaces the rows of the given templates in the resolution table, if
+    DBTEMPLATES_RESOLUTION_TABLE is enabled.
+    """
+    if settings.DBTEMPLATES_RESOLUTION_TABLE:
+        set_template_resolutions(template_ids)
+
+
+def set_template_resolutions(template_ids, site_ids=None):
+    """
+    Replaces the rows of the given templates in the resolution table.
+    Templates without any sites get a row for each of the given site ids,
+    or for every site if ``site_ids`` is None. Returns the number of rows.
+    """
+    template_ids = list(template_ids)
+    rows = Template.objects.filter(pk__in=template_ids).values_list(
+        'pk', 'name', 'content', 'last_changed')
+    sites = get_template_sites(template_ids)
+    resolutions = []
+    for pk, name, content, last_changed in rows:
+        if not sites[pk] and site_ids is None:
+            site_ids = list(Site.objects.values_list('pk', flat=True))
+        resolutions.extend(
+            TemplateResolution(site_id=site_id, name=name, template_id=pk,
+                               content=content, last_changed=last_changed)
+            for site_id in sites[pk] or site_ids)
+    TemplateResolution.objects.filter(template_id__in=template_ids).delete()
+    TemplateResolution.objects.bulk_create(resolutions, batch_size=500)
+    return len(resolutions)
+
+
+def add_templates_to_sites(template_ids, site_ids):
+    """
+    Adds the given templates to the given sites with a single insert
+    and refreshes their cached contents.
+    """
+    template_ids, site_ids = list(template_ids), list(site_ids)
+    through = Template.sites.through
+    existing = set(through.objects.filter(
+        template_id__in=template_ids, site_id__in=site_ids).values_list(
+        'template_id', 'site_id'))
+    through.objects.bulk_create([
+        through(template_id=template_id, site_id=site_id)
+        for template_id in template_ids for site_id in site_ids
+        if (template_id, site_id) not in existing])
+    touch_templates(template_ids)
+    update_template_resolutions(template_ids)
+    return refresh_cached_templates(template_ids)
+
+
+def remove_templates_from_sites(template_ids, site_ids):
+    """
+    Removes the given templates from the given sites with a single delete
+    and refreshes their cached contents.
+    """
+    template_ids = list(template_ids)
+    Template.sites.through.objects.filter(
+        template_id__in=template_ids, site_id__in=list(site_ids)).delete()
+    touch_templates(template_ids)
+    update_template_resolutions(template_ids)
+    return refresh_cached_templates(template_ids)
+
+
+def set_template_dependencies(templates):
+    """
+    Replaces the recorded dependencies of the given ``(pk, content)`` pairs
+    with the ones found in their contents, only writing those that changed.
+    """
+    templates = dict(templates)
+    found = dict((pk, set()) for pk in templates)
+    for pk, content in templates.items():
+        for kind, name in get_template_dependencies(content):
+            found[pk].add((kind, name))
+    existing = dict((pk, set()) for pk in templates)
+    for pk, kind, name in TemplateDependency.objects.filter(
+            template_id__in=list(templates)).values_list(
+            'template_id', 'kind', 'name'):
+        existing[pk].add((kind, name))
+    changed = [pk for pk in templates if found[pk] != existing[pk]]
+    if not changed:
+        return
+    TemplateDependency.objects.filter(template_id__in=changed).delete()
+    TemplateDependency.objects.bulk_create([
+        TemplateDependency(template_id=pk, kind=kind, name=name)
+        for pk in changed for kind, name in found[pk]])
+
+
+def get_dependents(template_name):
+    """
+    Returns the names of the templates that extend or include the template
+    with the given name, directly or through other templates, with a query
+    per level of nesting.
+    """
+    dependents, names = set(), set([template_name])
+    while names:
+        names = set(TemplateDependency.objects.filter(
+            name__in=names).values_list('template__name', flat=True))
+        names -= dependents
+        names.discard(template_name)
+        dependents |= names
+    return dependents
+
+
+@contextmanager
+def defer_cache_updates():
+    """
+    Collects the cache updates of the templates added, changed or deleted
+    in the block and applies them once per template at its end.
+
+    Wrap it around a transaction to keep concurrent requests from caching
+    contents that aren't committed yet, e.g.::
+
+        with defer_cache_updates():
+            with transaction.atomic():
+                template.save()
+                template.sites.add(site)
+    """
+    deferred.depth = getattr(deferred, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        deferred.depth -= 1
+        if not deferred.depth:
+            apply_deferred_cache_updates()
+
+
+def defer_cache_update(template_ids=(), template_names=()):
+    """
+    Records the cache updates of the given templates for the end of the
+    current defer_cache_updates() block, if there is one. Returns whether
+    they were deferred.
+    """
+    if not getattr(deferred, 'depth', 0):
+        return False
+    updates = getattr(deferred, 'updates', None)
+    if updates is None:
+        updates = deferred.updates = (set(), set())
+    updates[0].update(template_ids)
+    updates[1].update(template_names)
+    return True
+
+
+def apply_deferred_cache_updates():
+    """
+    Applies the cache updates collected by defer_cache_update().
+    """
+    updates = getattr(deferred, 'updates', None)
+    deferred.updates = None
+    if updates:
+        template_ids, template_names = updates
+        apply_cache_updates(template_ids, template_names)
+
+
+def apply_cache_updates(template_ids, template_names):
+    """
+    Removes the templates with the given names from the caches and replaces
+    the cached contents of the templates with the given ids, with a query
+    for their contents and a query for their site ids.
+    """
+    template_names = set(template_names)
+    if template_names:
+        remove_cached_templates(template_names)
+        remove_compiled_templates(template_names)
+    if template_ids:
+        refresh_cached_templates(template_ids)
+    if compiled_template_caches:
+        template_names.update(Template.objects.filter(
+            pk__in=template_ids).values_list('name', flat=True))
+        for name in template_names:
+            remove_compiled_templates(get_dependents(name))
+
+
 def add_default_site(instance, **kwargs):
     """
     Called via Django's signals to cache the templates, if the template
@@ -86,16 +367,107 @@ def add_default_site(instance, **kwargs):
         instance.sites.add(current_site)
 
 
+def refresh_cached_template(instance, **kwargs):
+    """
+    Called via Django's signals to cache a template and drop its negative
+    cache entries and compiled templates, if the template in the database
+    was added or changed. Deferred by defer_cache_updates().
+    """
+    if defer_cache_update(template_ids=[instance.pk]):
+        return
+    add_template_to_cache(instance)
+    remove_compiled_template(instance)
+    remove_compiled_dependents(instance)
+
+
+def forget_cached_template(instance, **kwargs):
+    """
+    Called via Django's signals to remove a template from the caches, if
+    the template in the database is deleted. Deferred by
+    defer_cache_updates().
+    """
+    if defer_cache_update(template_names=[instance.name]):
+        return
+    remove_cached_template(instance)
+    remove_compiled_template(instance)
+    remove_compiled_dependents(instance)
+
+
+def update_template_dependencies(instance, **kwargs):
+    """
+    Called via Django's signals to record the templates a template extends
+    or includes, if the template in the database was added or changed.
+    """
+    set_template_dependencies([(instance.pk, instance.content)])
+
+
+def remove_compiled_dependents(instance, **kwargs):
+    """
+    Called via Django's signals to drop the compiled templates extending
+    or including a template from the template caches of this process, if
+    the template in the database was changed or deleted.
+    """
+    if compiled_template_caches:
+        remove_compiled_templates(get_dependents(instance.name))
+
+
+def update_template_resolution(instance, **kwargs):
+    """
+    Called via Django's signals to update the resolution table, if the
+    template in the database was added or changed.
+    """
+    update_template_resolutions([instance.pk])
+
+
+def add_site_resolutions(instance, created, **kwargs):
+    """
+    Called via Django's signals to add the templates without any sites to
+    the resolution table for a new site.
+    """
+    if not created or not settings.DBTEMPLATES_RESOLUTION_TABLE:
+        return
+    TemplateResolution.objects.bulk_create([
+        TemplateResolution(site=instance, name=name, template_id=pk,
+                           content=content, last_changed=last_changed)
+        for pk, name, content, last_changed in Template.objects.filter(
+            sites=None).values_list('pk', 'name', 'content', 'last_changed')
+    ], batch_size=500)
+
+
 def change_sites(instance, action, model, pk_set, **kwargs):
-    if action == 'post_add' or action == 'post_remove':
-        if isinstance(instance, Site):
-            template_set = model.objects.filter(pk__in=pk_set)
-            map(add_template_to_cache, template_set)
-        elif isinstance(instance, Template):
+    """
+    Called via Django's signals to refresh the cached templates, if the
+    sites of a template or the templates of a site were changed.
+    """
+    if isinstance(instance, Site):
+        if action == 'pre_clear':
+            instance._dbtemplates_cleared = list(
+                instance.template_set.values_list('pk', flat=True))
+        elif action == 'post_clear':
+            template_ids = instance.__dict__.pop('_dbtemplates_cleared', [])
+            touch_templates(template_ids)
+            update_template_resolutions(template_ids)
+            if not defer_cache_update(template_ids=template_ids):
+                refresh_cached_templates(template_ids)
+        elif action in ('post_add', 'post_remove'):
+            touch_templates(pk_set)
+            update_template_resolutions(pk_set)
+            if not defer_cache_update(template_ids=pk_set):
+                refresh_cached_templates(pk_set)
+    elif isinstance(instance, Template):
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            touch_templates([instance.pk])
+            update_template_resolutions([instance.pk])
+            if defer_cache_update(template_ids=[instance.pk]):
+                return
             add_template_to_cache(instance)
+            remove_compiled_template(instance)
 
 
 signals.post_save.connect(add_default_site, sender=Template)
-signals.post_save.connect(add_template_to_cache, sender=Template)
-signals.pre_delete.connect(remove_cached_template, sender=Template)
+signals.post_save.connect(refresh_cached_template, sender=Template)
+signals.post_save.connect(update_template_dependencies, sender=Template)
+signals.post_save.connect(update_template_resolution, sender=Template)
+signals.post_save.connect(add_site_resolutions, sender=Site)
+signals.pre_delete.connect(forget_cached_template, sender=Template)
 signals.m2m_changed.connect(change_sites, sender=Template.sites.through)
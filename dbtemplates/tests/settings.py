@@ -12,7 +12,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:',
-    }
+    },
+    # a separate database standing in for a lagging read replica
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
 }
 
 INSTALLED_APPS = [
@@ -36,3 +41,11 @@ TEMPLATES = [
         },
     },
 ]
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        # room for the benchmarks, which would be skewed by culling
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
@@ -0,0 +1,216 @@
+"""
+Benchmarks of the template loader, the cache and the management commands,
+with query budgets that catch regressions of the hot paths.
+
+Run them with SQLite and the locmem cache like the other tests, e.g.::
+
+    py.test --ds=dbtemplates.tests.settings -s \
+        --pyargs dbtemplates.tests.test_benchmarks
+
+and set DBTEMPLATES_BENCHMARK_SCALE to a higher number to load more
+templates and sites.
+"""
+import codecs
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from django.conf import settings as django_settings
+from django.core.management import call_command
+from django.db import connection, reset_queries
+from django.template import Engine, TemplateDoesNotExist
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+
+from django.contrib.sites.models import Site
+
+from dbtemplates.conf import settings
+from dbtemplates.loader import Loader
+from dbtemplates.models import Template
+from dbtemplates.utils.cache import (cache, generations,
+                                     get_prefetched_templates)
+from dbtemplates.management.commands.sync_templates import (BATCH_SIZE,
+                                                           FILES_TO_DATABASE)
+
+SCALE = int(os.environ.get('DBTEMPLATES_BENCHMARK_SCALE', 1))
+# Django keeps at most 9000 queries in its log, so query budgets are
+# asserted for chunks of at most this many lookups, with a fresh log
+CHUNK_SIZE = 1000
+
+
+def report(name, count, duration):
+    sys.stdout.write("\n%s: %d in %.3fs, %.0f/s" % (
+        name, count, duration, count / duration if duration else 0))
+
+
+class LoaderBenchmark(TestCase):
+    template_count = 100 * SCALE
+    site_count = 3
+
+    def setUp(self):
+        self.old_site_id = django_settings.SITE_ID
+        self.sites = [Site.objects.get_current()] + [
+            Site.objects.create(domain='%d.example.com' % index,
+                                name='%d.example.com' % index)
+            for index in range(1, self.site_count)]
+        for site in self.sites:
+            # fill the site cache, which would skew the query counts
+            django_settings.SITE_ID = site.pk
+            Site.objects.get_current()
+        self.names = ['bench/%d.html' % index
+                      for index in range(self.template_count)]
+        Template.objects.bulk_create([Template(name=name, content=name * 10)
+                                      for name in self.names])
+        through = Template.sites.through
+        through.objects.bulk_create([
+            through(template=template, site=site)
+            for template in Template.objects.all() for site in self.sites])
+        self.loader = Loader(Engine.get_default())
+        cache.clear()
+        # forget the generations of the cleared cache, which would change
+        # in the middle of a benchmark otherwise
+        generations.clear()
+
+    def tearDown(self):
+        django_settings.SITE_ID = self.old_site_id
+        cache.clear()
+
+    def load_all(self, names, queries_per_lookup):
+        """
+        Looks the given templates up on every site, asserting the number of
+        queries per lookup.
+        """
+        start = time.time()
+        count = 0
+        for site in self.sites:
+            django_settings.SITE_ID = site.pk
+            for index in range(0, len(names), CHUNK_SIZE):
+                chunk = names[index:index + CHUNK_SIZE]
+                reset_queries()
+                with self.assertNumQueries(len(chunk) * queries_per_lookup):
+                    for name in chunk:
+                        try:
+                            self.loader.load_template_source(name)
+                        except TemplateDoesNotExist:
+                            pass
+                count += len(chunk)
+        return count, time.time() - start
+
+    def test_cold_cache(self):
+        # a single query per template and site, which only reads its content
+        # once, however many sites it has
+        count, duration = self.load_all(self.names, 1)
+        report('cold cache', count, duration)
+
+    def test_warm_cache(self):
+        self.load_all(self.names, 1)
+        count, duration = self.load_all(self.names, 0)
+        report('warm cache', count, duration)
+
+    def test_misses(self):
+        names = ['missing/%d.html' % index
+                 for index in range(self.template_count)]
+        count, duration = self.load_all(names, 1)
+        report('misses', count, duration)
+
+    def test_negative_cache(self):
+        old_negative_cache = settings.DBTEMPLATES_NEGATIVE_CACHE
+        try:
+            settings.DBTEMPLATES_NEGATIVE_CACHE = True
+            names = ['missing/%d.html' % index
+                     for index in range(self.template_count)]
+            self.load_all(names, 1)
+            count, duration = self.load_all(names, 0)
+            report('negative cache', count, duration)
+        finally:
+            settings.DBTEMPLATES_NEGATIVE_CACHE = old_negative_cache
+
+    def test_local_cache(self):
+        old_size = settings.DBTEMPLATES_LOCAL_CACHE_SIZE
+        try:
+            settings.DBTEMPLATES_LOCAL_CACHE_SIZE = 1024 * 1024 * 10
+            self.load_all(self.names, 1)
+            count, duration = self.load_all(self.names, 0)
+            report('local cache', count, duration)
+        finally:
+            settings.DBTEMPLATES_LOCAL_CACHE_SIZE = old_size
+
+    def test_prefetched_family(self):
+        old_settings = (settings.DBTEMPLATES_PREFETCH,
+                        settings.DBTEMPLATES_NEGATIVE_CACHE)
+        try:
+            settings.DBTEMPLATES_PREFETCH = True
+            settings.DBTEMPLATES_NEGATIVE_CACHE = True
+            Template.objects.create(
+                name='page.html',
+                content='{% extends "bench/0.html" %}' + ''.join(
+                    '{%% include "%s" %%}' % name for name in self.names))
+            cache.clear()
+            start = time.time()
+            reset_queries()
+            # the page and one query for its whole family
+            with self.assertNumQueries(2):
+                self.loader.load_template_source('page.html')
+                for name in self.names:
+                    self.loader.load_template_source(name)
+            report('prefetched family', len(self.names) + 1,
+                   time.time() - start)
+        finally:
+            (settings.DBTEMPLATES_PREFETCH,
+             settings.DBTEMPLATES_NEGATIVE_CACHE) = old_settings
+            get_prefetched_templates().clear()
+
+
+class CommandBenchmark(TestCase):
+    template_count = 200 * SCALE
+
+    def setUp(self):
+        self.old_template_dirs = Engine.get_default().dirs
+        self.template_dir = tempfile.mkdtemp('dbtemplates')
+        os.mkdir(os.path.join(self.template_dir, 'bench'))
+        for index in range(self.template_count):
+            path = os.path.join(self.template_dir, 'bench', '%d.html' % index)
+            with codecs.open(path, 'w') as f:
+                f.write('{%% if foo %%}%d{%% endif %%}' % index)
+        Engine.get_default().dirs = (self.template_dir,)
+        cache.clear()
+
+    def tearDown(self):
+        Engine.get_default().dirs = self.old_template_dirs
+        shutil.rmtree(self.template_dir)
+        cache.clear()
+
+    def sync(self):
+        start = time.time()
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('sync_templates', force=True, verbosity=0,
+                         bulk=True, overwrite=FILES_TO_DATABASE)
+        return len(queries), time.time() - start
+
+    def test_sync_templates(self):
+        queries, duration = self.sync()
+        count = Template.objects.count()
+        report('sync_templates', count, duration)
+        # a few queries, plus a query per batch of templates for each of
+        # creating them, adding them to the site, reading their ids,
+        # reading, deleting and adding their dependencies and refreshing
+        # their cached contents, their sites and the site ids
+        batches = int(math.ceil(float(count) / BATCH_SIZE))
+        self.assertTrue(queries <= 5 + 9 * batches)
+        queries, duration = self.sync()
+        report('incremental sync_templates', count, duration)
+        self.assertTrue(queries <= 3)
+
+    def test_check_template_syntax(self):
+        self.sync()
+        count = Template.objects.count()
+        start = time.time()
+        reset_queries()
+        with self.assertNumQueries(1):
+            call_command('check_template_syntax', stdout=StringIO())
+        report('check_template_syntax', count, time.time() - start)
@@ -1,21 +1,56 @@
 import codecs
+import json
 import os
 import shutil
 import tempfile
+import threading
+import time
+from datetime import datetime
 
 from django.conf import settings as django_settings
 from django.core.cache.backends.base import BaseCache
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.template import loader, Context, TemplateDoesNotExist, Engine
-from django.test import TestCase
+from django.db import DatabaseError, connection, transaction
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import six
+from django.utils.six import StringIO
 
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 
-from dbtemplates.conf import settings
-from dbtemplates.models import Template
-from dbtemplates.utils.cache import get_cache_backend, get_cache_key
+from dbtemplates.admin import TemplateAdmin
+from dbtemplates.conf import DbTemplatesConf, settings
+from dbtemplates.loader import Loader
+from dbtemplates.middleware import CurrentSiteMiddleware
+from dbtemplates.models import (Template, TemplateResolution,
+                                add_templates_to_sites, defer_cache_updates,
+                                get_dependents, set_template_dependencies,
+                                remove_templates_from_sites)
+from dbtemplates.utils import cache as cache_module
+from dbtemplates.utils.cache import (get_cache_backend, get_cache_key,
+                                     get_legacy_cache_key,
+                                     remove_legacy_cached_templates,
+                                     get_missing_cache_key, cache,
+                                     local_cache, LocalCache,
+                                     bump_cache_version, get_generations,
+                                     generations,
+                                     invalidate_cached_templates,
+                                     get_cache_timeout, template_lock,
+                                     template_locks, lock_key_format,
+                                     hash_template_name, RefreshPool,
+                                     cache_stats, chunk_key_format,
+                                     get_prefetched_templates, version_key)
+from dbtemplates.utils.sites import (clear_current_site_id, current_site_id,
+                                     get_current_site_id)
+from dbtemplates.utils.snapshot import TemplateSnapshot
+from dbtemplates.utils.stats import get_stats, merge_stats, metrics
 from dbtemplates.utils.template import (get_template_source,
+                                        get_template_dependencies,
                                         check_template_syntax)
 from dbtemplates.management.commands.sync_templates import (FILES_TO_DATABASE,
                                                             DATABASE_TO_FILES)
@@ -122,6 +157,116 @@ class DbTemplatesTestCase(TestCase):
             Engine.get_default().dirs = old_template_dirs
             shutil.rmtree(temp_template_dir)
 
+    def test_warm_template_cache(self):
+        cache.clear()
+        call_command('warm_template_cache', verbosity=0, batch_size=1)
+        self.assertEqual(cache.get(get_cache_key('base.html', self.site1.pk)),
+                         'base')
+        self.assertEqual(cache.get(get_cache_key('sub.html', self.site2.pk)),
+                         'sub')
+
+    def test_warm_template_cache_filters(self):
+        self.t1.sites.clear()
+        cache.clear()
+        call_command('warm_template_cache', verbosity=0,
+                     site=self.site2.domain, prefix='b')
+        self.assertEqual(cache.get(get_cache_key('base.html')), 'base')
+        self.assertEqual(cache.get(get_cache_key('sub.html', self.site2.pk)),
+                         None)
+
+    def test_sync_templates_bulk(self):
+        old_template_dirs = Engine.get_default().dirs
+        temp_template_dir = tempfile.mkdtemp('dbtemplates')
+        try:
+            for name, content in (('base.html', 'new base'),
+                                  ('sub.html', 'sub'),
+                                  ('new.html', 'new')):
+                with codecs.open(os.path.join(temp_template_dir, name),
+                                 'w') as f:
+                    f.write(content)
+            Engine.get_default().dirs = (temp_template_dir,)
+            self.t1.sites.clear()
+            cache.clear()
+            generations.clear()
+            # the admin's templates are synced as well
+            with CaptureQueriesContext(connection) as queries:
+                call_command('sync_templates', force=True, verbosity=0,
+                             bulk=True, overwrite=FILES_TO_DATABASE)
+            self.assertTrue(Template.objects.count() > 3)
+            self.assertTrue(len(queries) < 20)
+            self.assertEqual(Template.objects.get(name='base.html').content,
+                             'new base')
+            self.assertEqual(Template.objects.get(name='new.html').content,
+                             'new')
+            self.assertEqual(
+                Template.objects.exclude(sites=self.site1).count(), 0)
+            self.assertEqual(
+                cache.get(get_cache_key('new.html', self.site1.pk)), 'new')
+
+            Template.objects.filter(name='new.html').update(
+                content='modified')
+            call_command('sync_templates', verbosity=0, bulk=True,
+                         delete=True, overwrite=DATABASE_TO_FILES)
+            self.assertEqual(
+                codecs.open(os.path.join(temp_template_dir, 'new.html')
+                            ).read(), 'modified')
+            self.assertFalse(
+                Template.objects.filter(name='new.html').exists())
+        finally:
+            Engine.get_default().dirs = old_template_dirs
+            shutil.rmtree(temp_template_dir)
+
+    def test_sync_templates_incremental(self):
+        old_template_dirs = Engine.get_default().dirs
+        temp_template_dir = tempfile.mkdtemp('dbtemplates')
+        try:
+            for name, content in (('base.html', 'base'),
+                                  ('sub.html', 'changed sub'),
+                                  ('new.html', 'new')):
+                with codecs.open(os.path.join(temp_template_dir, name),
+                                 'w') as f:
+                    f.write(content)
+            Engine.get_default().dirs = (temp_template_dir,)
+            out = StringIO()
+            call_command('sync_templates', force=True, verbosity=0,
+                         bulk=True, dry_run=True, stdout=out,
+                         overwrite=FILES_TO_DATABASE)
+            changes = [json.loads(line) for line in
+                       out.getvalue().splitlines()]
+            diff = dict((change['name'], change['action'])
+                        for change in changes)
+            self.assertEqual(diff['new.html'], 'create')
+            self.assertEqual(diff['sub.html'], 'update')
+            self.assertFalse('base.html' in diff)
+            self.assertFalse(Template.objects.filter(
+                name='new.html').exists())
+
+            last_changed = Template.objects.get(name='base.html').last_changed
+            call_command('sync_templates', force=True, verbosity=0,
+                         bulk=True, overwrite=FILES_TO_DATABASE)
+            self.assertEqual(
+                Template.objects.get(name='base.html').last_changed,
+                last_changed)
+            self.assertEqual(Template.objects.get(name='sub.html').content,
+                             'changed sub')
+
+            out = StringIO()
+            call_command('sync_templates', force=True, verbosity=0,
+                         bulk=True, dry_run=True, stdout=out,
+                         overwrite=FILES_TO_DATABASE)
+            self.assertEqual(out.getvalue(), '')
+        finally:
+            Engine.get_default().dirs = old_template_dirs
+            shutil.rmtree(temp_template_dir)
+
+    def test_sync_templates_dry_run_requires_bulk(self):
+        self.assertRaises(CommandError, call_command, 'sync_templates',
+                          verbosity=0, dry_run=True)
+
+    def test_sync_templates_bulk_requires_overwrite(self):
+        self.assertRaises(CommandError, call_command, 'sync_templates',
+                          verbosity=0, bulk=True)
+
     def test_get_cache(self):
         self.assertTrue(isinstance(get_cache_backend(), BaseCache))
 
@@ -133,10 +278,1194 @@ class DbTemplatesTestCase(TestCase):
         self.assertFalse(check_template_syntax(bad_template)[0])
         self.assertTrue(check_template_syntax(good_template)[0])
 
+    def test_check_template_syntax_command(self):
+        Template.objects.create(name='bad.html', content='{% if foo %}Bar')
+        err = StringIO()
+        self.assertRaises(CommandError, call_command, 'check_template_syntax',
+                          jobs=2, stderr=err)
+        self.assertTrue(err.getvalue().startswith('bad.html: '))
+
+    def test_check_template_syntax_since(self):
+        Template.objects.create(name='bad.html', content='{% if foo %}Bar')
+        Template.objects.filter(name='bad.html').update(
+            last_changed=datetime(2000, 1, 1))
+        fd, watermark = tempfile.mkstemp('dbtemplates')
+        os.write(fd, b'2001-01-01T00:00:00')
+        os.close(fd)
+        try:
+            call_command('check_template_syntax', since='2001-01-01T00:00')
+            call_command('check_template_syntax', watermark=watermark)
+            with open(watermark) as f:
+                self.assertTrue(f.read() > '2001-01-01T00:00:00')
+            self.assertRaises(CommandError, call_command,
+                              'check_template_syntax', since='yesterday')
+        finally:
+            os.remove(watermark)
+
     def test_get_cache_name(self):
+        generations = get_generations([None, 1])
         self.assertEqual(get_cache_key('name with spaces'),
+                         'dbtemplates::v2::%s::*::'
+                         '0debc5903f22a059b0bfa6f5e33d47d8' % generations[None])
+        self.assertEqual(get_cache_key('name with spaces', 1),
+                         'dbtemplates::v2::%s::1::'
+                         '0debc5903f22a059b0bfa6f5e33d47d8' % generations[1])
+        self.assertEqual(get_legacy_cache_key('name with spaces'),
                          'dbtemplates::name-with-spaces')
 
+    def test_remove_legacy_cached_templates(self):
+        cache.set(get_legacy_cache_key('base.html'), {'content': 'base'})
+        remove_legacy_cached_templates(['base.html'])
+        self.assertEqual(cache.get(get_legacy_cache_key('base.html')), None)
+
+    def test_cache_keys_dont_collide(self):
+        keys = set(get_cache_key(name, self.site1.pk)
+                   for name in ('a/b.html', 'ab.html', 'a-b.html'))
+        self.assertEqual(len(keys), 3)
+
+
+class NegativeCacheTestCase(TestCase):
+    def setUp(self):
+        self.old_negative_cache = settings.DBTEMPLATES_NEGATIVE_CACHE
+        settings.DBTEMPLATES_NEGATIVE_CACHE = True
+        self.site = Site.objects.get_current()
+        self.loader = Loader(Engine.get_default())
+        cache.clear()
+
+    def tearDown(self):
+        settings.DBTEMPLATES_NEGATIVE_CACHE = self.old_negative_cache
+        cache.clear()
+
+    def test_miss_is_remembered(self):
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, 'missing.html')
+        self.assertTrue(
+            cache.get(get_missing_cache_key('missing.html', self.site.pk)))
+        with self.assertNumQueries(0):
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source,
+                              'missing.html')
+
+    def test_miss_is_forgotten_on_save(self):
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, 'missing.html')
+        Template.objects.create(name='missing.html', content='found')
+        source, _ = self.loader.load_template_source('missing.html')
+        self.assertEqual(source, 'found')
+
+    def test_miss_is_forgotten_on_site_change(self):
+        other_site = Site.objects.create(domain='example.org',
+                                         name='example.org')
+        template = Template.objects.create(name='missing.html',
+                                           content='found')
+        template.sites.add(other_site)
+        template.sites.remove(self.site)
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, 'missing.html')
+        template.sites.add(self.site.pk)
+        source, _ = self.loader.load_template_source('missing.html')
+        self.assertEqual(source, 'found')
+
+        template.sites.remove(self.site)
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, 'missing.html')
+        self.site.template_set.add(template)
+        source, _ = self.loader.load_template_source('missing.html')
+        self.assertEqual(source, 'found')
+
+
+class LoaderQueryCountTestCase(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='example.org',
+                                              name='example.org')
+        self.loader = Loader(Engine.get_default())
+        self.template = Template.objects.create(name='base.html',
+                                                content='base')
+        self.template.sites.add(self.other_site)
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_miss_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            source, _ = self.loader.load_template_source('base.html')
+        self.assertEqual(source, 'base')
+        self.assertEqual(cache.get(get_cache_key('base.html', self.site.pk)),
+                         'base')
+        # only the requested site is joined, so only its key is cached
+        self.assertEqual(
+            cache.get(get_cache_key('base.html', self.other_site.pk)), None)
+        with self.assertNumQueries(0):
+            self.loader.load_template_source('base.html')
+
+    def test_missing_template_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source,
+                              'missing.html')
+
+    def test_other_site_template_is_not_found(self):
+        self.template.sites.remove(self.site)
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source,
+                              'base.html')
+
+    def test_siteless_template(self):
+        self.template.sites.clear()
+        cache.clear()
+        with self.assertNumQueries(1):
+            source, _ = self.loader.load_template_source('base.html')
+        self.assertEqual(source, 'base')
+        with self.assertNumQueries(0):
+            self.loader.load_template_source('base.html')
+
+
+class RecordingCache(object):
+    """
+    Wraps a cache backend and records the names of the methods called.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            return attr(*args, **kwargs)
+        return call
+
+
+class LocalCacheTestCase(TestCase):
+    def setUp(self):
+        self.old_size = settings.DBTEMPLATES_LOCAL_CACHE_SIZE
+        self.old_interval = settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL
+        settings.DBTEMPLATES_LOCAL_CACHE_SIZE = 1024
+        settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL = 60
+        self.loader = Loader(Engine.get_default())
+        Site.objects.get_current()
+        cache.clear()
+        local_cache.clear()
+
+    def tearDown(self):
+        settings.DBTEMPLATES_LOCAL_CACHE_SIZE = self.old_size
+        settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL = self.old_interval
+        cache.clear()
+        local_cache.clear()
+
+    def recording_cache(self):
+        recording = RecordingCache(cache_module.cache)
+        cache_module.cache = recording
+        self.addCleanup(setattr, cache_module, 'cache', recording.backend)
+        return recording
+
+    def test_hit_skips_cache_backend(self):
+        Template.objects.create(name='base.html', content='base')
+        self.loader.load_template_source('base.html')
+        self.loader.load_template_source('base.html')
+        recording = self.recording_cache()
+        with self.assertNumQueries(0):
+            for i in range(3):
+                source, _ = self.loader.load_template_source('base.html')
+        self.assertEqual(source, 'base')
+        self.assertEqual(recording.calls, [])
+
+    def test_siteless_hit_skips_cache_backend(self):
+        template = Template.objects.create(name='base.html', content='base')
+        template.sites.clear()
+        self.loader.load_template_source('base.html')
+        self.loader.load_template_source('base.html')
+        recording = self.recording_cache()
+        source, _ = self.loader.load_template_source('base.html')
+        self.assertEqual(source, 'base')
+        self.assertEqual(recording.calls, [])
+
+    def test_negative_hit_skips_cache_backend(self):
+        old_negative_cache = settings.DBTEMPLATES_NEGATIVE_CACHE
+        settings.DBTEMPLATES_NEGATIVE_CACHE = True
+        self.addCleanup(setattr, settings, 'DBTEMPLATES_NEGATIVE_CACHE',
+                        old_negative_cache)
+        for i in range(2):
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source, 'missing.html')
+        recording = self.recording_cache()
+        with self.assertNumQueries(0):
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source, 'missing.html')
+        self.assertEqual(recording.calls, [])
+
+    def test_save_drops_entry(self):
+        template = Template.objects.create(name='base.html', content='base')
+        self.loader.load_template_source('base.html')
+        template.content = 'changed'
+        template.save()
+        source, _ = self.loader.load_template_source('base.html')
+        self.assertEqual(source, 'changed')
+
+    def test_version_change_drops_entries(self):
+        Template.objects.create(name='base.html', content='base')
+        self.loader.load_template_source('base.html')
+        self.assertTrue(local_cache.entries)
+        settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL = 0
+        bump_cache_version()
+        local_cache.validate()
+        self.assertFalse(local_cache.entries)
+
+    def test_lru_eviction(self):
+        settings.DBTEMPLATES_LOCAL_CACHE_SIZE = 10
+        lru = LocalCache()
+        lru.validate()
+        lru.set('a', 'a', 4, lru.version)
+        lru.set('b', 'b', 4, lru.version)
+        lru.get('a')
+        lru.set('c', 'c', 4, lru.version)
+        self.assertEqual(list(lru.entries), ['a', 'c'])
+        self.assertEqual(lru.size, 8)
+        lru.set('d', 'd', 11, lru.version)
+        self.assertEqual(lru.get('d'), None)
+
+    def test_stale_version_is_not_stored(self):
+        lru = LocalCache()
+        lru.validate()
+        lru.set('a', 'a', 1, 'outdated')
+        self.assertEqual(lru.get('a'), None)
+
+    def test_expired_entry_is_dropped(self):
+        lru = LocalCache()
+        lru.validate()
+        lru.set('a', 'a', 1, lru.version, timeout=-1)
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.size, 0)
+
+    def enable_negative_cache(self):
+        old_negative_cache = settings.DBTEMPLATES_NEGATIVE_CACHE
+        settings.DBTEMPLATES_NEGATIVE_CACHE = True
+        self.addCleanup(setattr, settings, 'DBTEMPLATES_NEGATIVE_CACHE',
+                        old_negative_cache)
+
+    def test_negative_entry_expires(self):
+        self.enable_negative_cache()
+        for i in range(2):
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source, 'missing.html')
+        key = get_missing_cache_key('missing.html',
+                                    Site.objects.get_current().pk)
+        value, size, expires = local_cache.entries[key]
+        self.assertTrue(value)
+        self.assertTrue(expires <= time.time() +
+                        settings.DBTEMPLATES_NEGATIVE_CACHE_TIMEOUT)
+
+    def test_version_is_bumped_after_writes(self):
+        # other processes revalidating their local caches as soon as the
+        # version changes must find the new template, not its negative
+        # cache entry
+        self.enable_negative_cache()
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, 'new.html')
+        site_id = Site.objects.get_current().pk
+        backend = cache_module.cache
+        incr, seen = backend.incr, []
+
+        def recording_incr(key, *args, **kwargs):
+            if key == version_key:
+                seen.append((
+                    backend.get(get_cache_key('new.html', site_id)),
+                    backend.get(get_missing_cache_key('new.html', site_id))))
+            return incr(key, *args, **kwargs)
+        backend.incr = recording_incr
+        self.addCleanup(delattr, backend, 'incr')
+        Template.objects.create(name='new.html', content='new')
+        self.assertTrue(seen)
+        self.assertEqual(set(seen), set([('new', None)]))
+
+
+class TemplateDependencyTestCase(TestCase):
+    def setUp(self):
+        self.base = Template.objects.create(name='base.html', content='base')
+        self.page = Template.objects.create(
+            name='page.html',
+            content='{% extends "base.html" %}{% block a %}'
+                    '{% include "menu.html" %}{% include menu %}'
+                    '{% endblock %}')
+        self.blog = Template.objects.create(
+            name='blog.html', content="{% extends 'page.html' %}")
+
+    def test_get_template_dependencies(self):
+        self.assertEqual(get_template_dependencies(self.page.content),
+                         [('extends', 'base.html'),
+                          ('include', 'menu.html')])
+        self.assertEqual(get_template_dependencies('{{ "base.html" }}'), [])
+
+    def test_dependencies_are_recorded_on_save(self):
+        self.assertEqual(
+            sorted(self.page.dependencies.values_list('kind', 'name')),
+            [('extends', 'base.html'), ('include', 'menu.html')])
+        self.page.content = '{% include "menu.html" %}'
+        self.page.save()
+        self.assertEqual(
+            list(self.page.dependencies.values_list('kind', 'name')),
+            [('include', 'menu.html')])
+
+    def test_unchanged_dependencies_are_not_rewritten(self):
+        with self.assertNumQueries(1):
+            set_template_dependencies([(self.page.pk, self.page.content)])
+
+    def test_get_dependents(self):
+        self.assertEqual(get_dependents('base.html'),
+                         set(['page.html', 'blog.html']))
+        self.assertEqual(get_dependents('menu.html'),
+                         set(['page.html', 'blog.html']))
+        self.assertEqual(get_dependents('blog.html'), set())
+
+    def test_save_drops_compiled_dependents(self):
+        engine = Engine(loaders=[
+            ('dbtemplates.loader.CachedLoader', ['dbtemplates.loader.Loader']),
+        ])
+        compiled = engine.get_template('blog.html')
+        self.assertTrue(engine.get_template('blog.html') is compiled)
+        self.base.save()
+        self.assertFalse(engine.get_template('blog.html') is compiled)
+
+    def test_admin_lists_dependents(self):
+        admin = TemplateAdmin(Template, AdminSite())
+        self.assertEqual(admin.used_by(self.base), 'blog.html, page.html')
+        self.assertEqual(admin.used_by(Template(name='base.html')), '')
+
+
+class PrefetchTestCase(TestCase):
+    def setUp(self):
+        self.old_settings = (settings.DBTEMPLATES_PREFETCH,
+                             settings.DBTEMPLATES_NEGATIVE_CACHE)
+        settings.DBTEMPLATES_PREFETCH = True
+        settings.DBTEMPLATES_NEGATIVE_CACHE = True
+        self.loader = Loader(Engine.get_default())
+        Template.objects.create(name='base.html', content='base')
+        Template.objects.create(name='menu.html',
+                                content='{% include "item.html" %}')
+        Template.objects.create(name='item.html', content='item')
+        Template.objects.create(
+            name='page.html',
+            content='{% extends "base.html" %}{% block a %}'
+                    '{% include "menu.html" %}{% include "file.html" %}'
+                    '{% endblock %}')
+        cache.clear()
+
+    def tearDown(self):
+        (settings.DBTEMPLATES_PREFETCH,
+         settings.DBTEMPLATES_NEGATIVE_CACHE) = self.old_settings
+        get_prefetched_templates().clear()
+        cache.clear()
+
+    def test_family_is_fetched_with_a_query_per_level(self):
+        with self.assertNumQueries(3):
+            self.loader.load_template_source('page.html')
+        display_names = []
+        with self.assertNumQueries(0):
+            for name, content in (('base.html', 'base'),
+                                  ('item.html', 'item')):
+                source, display_name = self.loader.load_template_source(name)
+                self.assertEqual(source, content)
+                display_names.append(display_name)
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source, 'file.html')
+        for display_name in display_names:
+            self.assertTrue(display_name.startswith('dbtemplates:prefetch'))
+        self.assertEqual(cache.get(get_cache_key('menu.html', 1)),
+                         '{% include "item.html" %}')
+
+    def test_load_template_sources(self):
+        names = ['base.html', 'item.html', 'file.html']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.loader.load_template_sources(names),
+                             {'base.html': 'base', 'item.html': 'item'})
+        with self.assertNumQueries(0):
+            self.loader.load_template_sources(names)
+
+    def test_cached_family_needs_no_queries(self):
+        self.loader.load_template_source('page.html')
+        get_prefetched_templates().clear()
+        # including file.html, which only the negative cache knows is
+        # missing from the database
+        with self.assertNumQueries(0):
+            self.loader.load_template_source('page.html')
+            self.loader.load_template_source('menu.html')
+
+    def test_requires_negative_cache(self):
+        conf = DbTemplatesConf()
+        configured_data = conf._meta.configured_data
+        conf._meta.configured_data = dict(configured_data, PREFETCH=True,
+                                          NEGATIVE_CACHE=False)
+        try:
+            self.assertRaises(ImproperlyConfigured, conf.configure)
+        finally:
+            conf._meta.configured_data = configured_data
+
+    def test_saving_drops_prefetched_templates(self):
+        self.loader.load_template_source('page.html')
+        Template.objects.filter(name='base.html').get().save()
+        self.assertEqual(get_prefetched_templates(), {})
+
+
+reported_metrics = []
+
+
+def report_metric(kind, metric, value, site_id, template_name):
+    reported_metrics.append((kind, metric, site_id, template_name))
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.old_settings = (settings.DBTEMPLATES_METRICS,
+                             settings.DBTEMPLATES_METRICS_PER_TEMPLATE,
+                             settings.DBTEMPLATES_METRICS_CALLBACK)
+        settings.DBTEMPLATES_METRICS = True
+        self.site = Site.objects.get_current()
+        self.loader = Loader(Engine.get_default())
+        Template.objects.create(name='base.html', content='base')
+        metrics.reset()
+        cache.clear()
+
+    def tearDown(self):
+        (settings.DBTEMPLATES_METRICS,
+         settings.DBTEMPLATES_METRICS_PER_TEMPLATE,
+         settings.DBTEMPLATES_METRICS_CALLBACK) = self.old_settings
+        del reported_metrics[:]
+        metrics.reset()
+        cache.clear()
+
+    def test_load_path_is_counted(self):
+        self.loader.load_template_source('base.html')
+        self.loader.load_template_source('base.html')
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, 'missing.html')
+        counters, timings = merge_stats([get_stats()])
+        site_id = self.site.pk
+        self.assertEqual(counters[('cache_misses', site_id, None)], 2)
+        self.assertEqual(counters[('cache_hits', site_id, None)], 1)
+        self.assertEqual(counters[('db_hits', site_id, None)], 1)
+        self.assertEqual(counters[('db_misses', site_id, None)], 1)
+        self.assertEqual(counters[('bytes_served', site_id, None)], 8)
+        self.assertEqual(timings[('load_time', site_id, None)][0], 3)
+        self.assertEqual(timings[('db_time', site_id, None)][0], 2)
+
+    def test_per_template_metrics(self):
+        settings.DBTEMPLATES_METRICS_PER_TEMPLATE = True
+        self.loader.load_template_source('base.html')
+        counters, timings = merge_stats([get_stats()])
+        self.assertEqual(
+            counters[('db_hits', self.site.pk, 'base.html')], 1)
+
+    def test_disabled_metrics_are_not_recorded(self):
+        settings.DBTEMPLATES_METRICS = False
+        self.loader.load_template_source('base.html')
+        self.assertEqual(get_stats()['counters'], [])
+
+    def test_callback(self):
+        settings.DBTEMPLATES_METRICS_CALLBACK = (
+            'dbtemplates.tests.test_cases.report_metric')
+        self.loader.load_template_source('base.html')
+        self.assertTrue(('incr', 'db_hits', self.site.pk, None)
+                        in reported_metrics)
+        self.assertTrue(('timing', 'load_time', self.site.pk, None)
+                        in reported_metrics)
+
+    def test_template_stats_command(self):
+        self.loader.load_template_source('base.html')
+        out = StringIO()
+        call_command('template_stats', stdout=out)
+        self.assertTrue('db_hits site=%d 1' % self.site.pk
+                        in out.getvalue())
+        out = StringIO()
+        call_command('template_stats', json=True, stdout=out)
+        self.assertEqual(json.loads(out.getvalue())[0]['process'],
+                         metrics.process)
+
+
+class CurrentSiteTestCase(TestCase):
+    def setUp(self):
+        self.other_site = Site.objects.create(domain='example.org',
+                                              name='example.org')
+        self.template = Template.objects.create(name='base.html',
+                                                content='base')
+        self.template.sites = [self.other_site]
+        self.loader = Loader(Engine.get_default())
+        Site.objects.clear_cache()
+        cache.clear()
+
+    def tearDown(self):
+        clear_current_site_id()
+        cache.clear()
+
+    def test_loader_uses_current_site_id(self):
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, 'base.html')
+        with current_site_id(self.other_site.pk):
+            # no query for the site itself
+            with self.assertNumQueries(1):
+                source, display_name = self.loader.load_template_source(
+                    'base.html')
+            self.assertEqual(source, 'base')
+            with self.assertNumQueries(1):
+                self.assertEqual(display_name,
+                                 'dbtemplates:default:base.html:example.org')
+        self.assertEqual(get_current_site_id(), django_settings.SITE_ID)
+
+    def test_middleware(self):
+        middleware = CurrentSiteMiddleware()
+        request = RequestFactory().get('/')
+        request.site = self.other_site
+        middleware.process_request(request)
+        self.assertEqual(get_current_site_id(), self.other_site.pk)
+        self.assertEqual(self.loader.load_template_source('base.html')[0],
+                         'base')
+        middleware.process_response(request, None)
+        self.assertEqual(get_current_site_id(), django_settings.SITE_ID)
+
+
+class TemplateResolutionTestCase(TestCase):
+    def setUp(self):
+        self.old_resolution_table = settings.DBTEMPLATES_RESOLUTION_TABLE
+        settings.DBTEMPLATES_RESOLUTION_TABLE = True
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='example.org',
+                                              name='example.org')
+        self.template = Template.objects.create(name='base.html',
+                                                content='base')
+        self.siteless = Template.objects.create(name='siteless.html',
+                                                content='siteless')
+        self.siteless.sites.clear()
+        self.loader = Loader(Engine.get_default())
+        cache.clear()
+
+    def tearDown(self):
+        settings.DBTEMPLATES_RESOLUTION_TABLE = self.old_resolution_table
+        cache.clear()
+
+    def get_resolutions(self):
+        return sorted(TemplateResolution.objects.values_list(
+            'site_id', 'name', 'content'))
+
+    def test_table_follows_templates_and_sites(self):
+        self.assertEqual(self.get_resolutions(), [
+            (self.site.pk, 'base.html', 'base'),
+            (self.site.pk, 'siteless.html', 'siteless'),
+            (self.other_site.pk, 'siteless.html', 'siteless'),
+        ])
+        self.template.sites.add(self.other_site)
+        self.template.name = 'renamed.html'
+        self.template.save()
+        new_site = Site.objects.create(domain='example.net',
+                                       name='example.net')
+        self.assertEqual(self.get_resolutions(), [
+            (self.site.pk, 'renamed.html', 'base'),
+            (self.site.pk, 'siteless.html', 'siteless'),
+            (self.other_site.pk, 'renamed.html', 'base'),
+            (self.other_site.pk, 'siteless.html', 'siteless'),
+            (new_site.pk, 'siteless.html', 'siteless'),
+        ])
+        self.other_site.template_set.clear()
+        self.assertEqual(TemplateResolution.objects.filter(
+            site=self.other_site).count(), 1)
+        self.template.delete()
+        self.assertFalse(TemplateResolution.objects.filter(
+            name='renamed.html').exists())
+
+    def test_loader_uses_resolution_table(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.loader.load_template_source('siteless.html')[0],
+                'siteless')
+        self.assertEqual(cache.get(get_cache_key('siteless.html',
+                                                 self.site.pk)), 'siteless')
+        with current_site_id(self.other_site.pk):
+            with self.assertNumQueries(1):
+                self.assertRaises(TemplateDoesNotExist,
+                                  self.loader.load_template_source,
+                                  'base.html')
+
+    def test_rebuild_command(self):
+        TemplateResolution.objects.all().delete()
+        call_command('rebuild_template_resolution', verbosity=0)
+        self.assertEqual(TemplateResolution.objects.count(), 3)
+
+
+class ReadDatabaseTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.old_settings = (settings.DBTEMPLATES_READ_DATABASE,
+                             settings.DBTEMPLATES_NEGATIVE_CACHE)
+        settings.DBTEMPLATES_READ_DATABASE = 'replica'
+        settings.DBTEMPLATES_NEGATIVE_CACHE = True
+        self.site = Site.objects.get_current()
+        self.loader = Loader(Engine.get_default())
+        cache.clear()
+
+    def tearDown(self):
+        (settings.DBTEMPLATES_READ_DATABASE,
+         settings.DBTEMPLATES_NEGATIVE_CACHE) = self.old_settings
+        cache.clear()
+
+    def test_templates_are_read_from_replica(self):
+        # written by replication, without any signals
+        Template.objects.using('replica').bulk_create([
+            Template(pk=1, name='replicated.html', content='replicated')])
+        with self.assertNumQueries(0):
+            with self.assertNumQueries(1, using='replica'):
+                source, display_name = self.loader.load_template_source(
+                    'replicated.html')
+        self.assertEqual(source, 'replicated')
+        self.assertTrue(
+            six.text_type(display_name).startswith('dbtemplates:replica:'))
+
+    def test_replica_miss_falls_back_to_primary(self):
+        Template.objects.create(name='new.html', content='new')
+        cache.clear()
+        with self.assertNumQueries(1):
+            with self.assertNumQueries(1, using='replica'):
+                source, display_name = self.loader.load_template_source(
+                    'new.html')
+        self.assertEqual(source, 'new')
+        # the origin is the database it was actually read from
+        self.assertTrue(
+            six.text_type(display_name).startswith('dbtemplates:default:'))
+        with self.assertNumQueries(1):
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source, 'gone.html')
+        self.assertTrue(
+            cache.get(get_missing_cache_key('gone.html', self.site.pk)))
+        self.assertEqual(
+            cache.get(get_missing_cache_key('new.html', self.site.pk)), None)
+
+
+class CachedLoaderTestCase(TestCase):
+    def setUp(self):
+        self.engine = Engine(loaders=[
+            ('dbtemplates.loader.CachedLoader', ['dbtemplates.loader.Loader']),
+        ])
+        self.template = Template.objects.create(name='base.html',
+                                                content='base')
+
+    def test_compiled_template_is_reused(self):
+        compiled = self.engine.get_template('base.html')
+        self.assertTrue(self.engine.get_template('base.html') is compiled)
+
+    def test_save_drops_compiled_template(self):
+        self.assertEqual(
+            self.engine.get_template('base.html').render(Context()), 'base')
+        self.template.content = 'changed'
+        self.template.save()
+        self.assertEqual(
+            self.engine.get_template('base.html').render(Context()),
+            'changed')
+
+    def test_create_drops_cached_miss(self):
+        self.assertRaises(TemplateDoesNotExist,
+                          self.engine.get_template, 'new.html')
+        Template.objects.create(name='new.html', content='new')
+        self.assertEqual(
+            self.engine.get_template('new.html').render(Context()), 'new')
+
+    def test_compiled_templates_are_kept_per_site(self):
+        other_site = Site.objects.create(domain='example.org',
+                                         name='example.org')
+        self.template.sites.add(other_site)
+        compiled = self.engine.get_template('base.html')
+        old_site_id = django_settings.SITE_ID
+        try:
+            django_settings.SITE_ID = other_site.pk
+            self.assertFalse(self.engine.get_template('base.html') is compiled)
+        finally:
+            django_settings.SITE_ID = old_site_id
+
+    def test_version_change_resets_loader(self):
+        compiled = self.engine.get_template('base.html')
+        old_interval = settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL
+        try:
+            settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL = 0
+            bump_cache_version()
+            self.assertFalse(self.engine.get_template('base.html') is compiled)
+        finally:
+            settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL = old_interval
+
+
+class TemplateAdminActionsTestCase(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='example.org',
+                                              name='example.org')
+        self.templates = [
+            Template.objects.create(name='%d.html' % i, content=str(i))
+            for i in range(3)]
+        self.admin = TemplateAdmin(Template, AdminSite())
+        self.admin.message_user = lambda request, message: None
+        self.queryset = Template.objects.all()
+        self.factory = RequestFactory()
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_repopulate_cache(self):
+        request = self.factory.post('/')
+        with self.assertNumQueries(3):
+            self.admin.repopulate_cache(request, self.queryset)
+        self.assertEqual(cache.get(get_cache_key('1.html', self.site.pk)),
+                         '1')
+
+    def test_invalidate_cache(self):
+        request = self.factory.post('/')
+        self.admin.repopulate_cache(request, self.queryset)
+        with self.assertNumQueries(2):
+            self.admin.invalidate_cache(request, self.queryset)
+        self.assertEqual(cache.get(get_cache_key('1.html', self.site.pk)),
+                         None)
+
+    def test_change_sites_shows_form(self):
+        request = self.factory.post('/')
+        request.user = User(is_active=True, is_staff=True)
+        response = self.admin.add_to_sites(request, self.queryset)
+        self.assertEqual(response.template_name,
+                         TemplateAdmin.change_sites_template)
+        self.assertEqual(len(response.context_data['selected']), 3)
+
+    def test_add_and_remove_sites(self):
+        request = self.factory.post(
+            '/', {'apply': 'yes', 'sites': [self.other_site.pk]})
+        self.assertEqual(
+            self.admin.add_to_sites(request, self.queryset), None)
+        self.assertEqual(
+            Template.objects.filter(sites=self.other_site).count(), 3)
+        self.assertEqual(
+            cache.get(get_cache_key('1.html', self.other_site.pk)), '1')
+
+        self.assertEqual(
+            self.admin.remove_from_sites(request, self.queryset), None)
+        self.assertEqual(
+            Template.objects.filter(sites=self.other_site).count(), 0)
+        self.assertEqual(
+            cache.get(get_cache_key('1.html', self.other_site.pk)), None)
+        self.assertEqual(cache.get(get_cache_key('1.html', self.site.pk)),
+                         '1')
+
+    def test_add_templates_to_sites_skips_existing(self):
+        ids = [template.pk for template in self.templates]
+        add_templates_to_sites(ids, [self.site.pk, self.other_site.pk])
+        self.assertEqual(Template.sites.through.objects.count(), 6)
+        remove_templates_from_sites(ids, [self.site.pk])
+        self.assertEqual(Template.sites.through.objects.count(), 3)
+
+
+class SiteTemplatesChangeTestCase(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='example.org',
+                                              name='example.org')
+        self.templates = [
+            Template.objects.create(name='%d.html' % i, content=str(i))
+            for i in range(3)]
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def cached(self, site):
+        return [cache.get(get_cache_key(template.name, site.pk))
+                for template in self.templates]
+
+    def test_add_templates_to_site(self):
+        with self.assertNumQueries(5):
+            self.other_site.template_set.add(*self.templates)
+        self.assertEqual(self.cached(self.other_site), ['0', '1', '2'])
+        self.assertEqual(self.cached(self.site), ['0', '1', '2'])
+
+    def test_templates_are_only_touched_for_snapshots(self):
+        last_changed = Template.objects.get(pk=self.templates[0].pk
+                                            ).last_changed
+        self.other_site.template_set.add(*self.templates)
+        self.assertEqual(Template.objects.get(
+            pk=self.templates[0].pk).last_changed, last_changed)
+
+    def test_remove_templates_from_site(self):
+        self.other_site.template_set.add(*self.templates)
+        self.other_site.template_set.remove(self.templates[0])
+        self.assertEqual(self.cached(self.other_site), [None, '1', '2'])
+
+    def test_clear_site_templates(self):
+        self.other_site.template_set.add(*self.templates)
+        self.other_site.template_set.clear()
+        self.assertEqual(self.cached(self.other_site), [None, None, None])
+        self.assertEqual(self.cached(self.site), ['0', '1', '2'])
+
+    def test_clear_template_sites(self):
+        template = self.templates[0]
+        template.sites.add(self.other_site)
+        template.sites.clear()
+        self.assertEqual(cache.get(get_cache_key(template.name)), '0')
+        self.assertEqual(
+            cache.get(get_cache_key(template.name, self.site.pk)), None)
+
+
+class DeferredCacheUpdatesTestCase(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='example.org',
+                                              name='example.org')
+        self.template = Template.objects.create(name='base.html',
+                                                content='old')
+        self.key = get_cache_key('base.html', self.site.pk)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_defers_until_end_of_block(self):
+        with defer_cache_updates():
+            self.template.content = 'new'
+            self.template.save()
+            self.template.sites.add(self.other_site)
+            # readers keep the cached content until the changes are done
+            self.assertEqual(cache.get(self.key), 'old')
+        self.assertEqual(cache.get(self.key), 'new')
+        self.assertEqual(
+            cache.get(get_cache_key('base.html', self.other_site.pk)), 'new')
+
+    def apply_queries(self, templates, saves):
+        with CaptureQueriesContext(connection) as queries:
+            with defer_cache_updates():
+                for i in range(saves):
+                    for template in templates:
+                        template.save()
+                        template.sites.add(self.other_site)
+                start = len(queries)
+        return len(queries) - start
+
+    def test_applies_once_per_template(self):
+        templates = [self.template,
+                     Template.objects.create(name='other.html',
+                                             content='other')]
+        self.assertEqual(self.apply_queries(templates, 3),
+                         self.apply_queries(templates, 1))
+        self.assertEqual(cache.get(get_cache_key('other.html', self.site.pk)),
+                         'other')
+
+    def test_nested_blocks(self):
+        with defer_cache_updates():
+            with defer_cache_updates():
+                self.template.content = 'new'
+                self.template.save()
+            self.assertEqual(cache.get(self.key), 'old')
+        self.assertEqual(cache.get(self.key), 'new')
+
+    def test_delete(self):
+        with defer_cache_updates():
+            self.template.delete()
+            self.assertEqual(cache.get(self.key), 'old')
+        self.assertEqual(cache.get(self.key), None)
+
+    def test_not_deferred_outside_block(self):
+        self.template.content = 'new'
+        self.template.save()
+        self.assertEqual(cache.get(self.key), 'new')
+
+
+class CacheGenerationTestCase(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='example.org',
+                                              name='example.org')
+        self.loader = Loader(Engine.get_default())
+        self.template = Template.objects.create(name='base.html',
+                                                content='base')
+        self.siteless = Template.objects.create(name='siteless.html',
+                                                content='siteless')
+        self.siteless.sites.clear()
+        self.loader.load_template_source('base.html')
+        self.loader.load_template_source('siteless.html')
+
+    def test_invalidate_all(self):
+        call_command('invalidate_template_cache', verbosity=0)
+        with self.assertNumQueries(1):
+            self.loader.load_template_source('base.html')
+        with self.assertNumQueries(1):
+            self.loader.load_template_source('siteless.html')
+
+    def test_invalidate_site(self):
+        call_command('invalidate_template_cache', verbosity=0,
+                     site=str(self.site.pk))
+        with self.assertNumQueries(1):
+            self.loader.load_template_source('base.html')
+        with self.assertNumQueries(0):
+            self.loader.load_template_source('siteless.html')
+
+    def test_invalidate_other_site(self):
+        old_generations = get_generations([self.site.pk])
+        invalidate_cached_templates(self.other_site.pk)
+        self.assertEqual(get_generations([self.site.pk]), old_generations)
+        with self.assertNumQueries(0):
+            self.loader.load_template_source('base.html')
+
+
+class CacheStampedeTestCase(TestCase):
+    def setUp(self):
+        self.old_lock_timeout = settings.DBTEMPLATES_CACHE_LOCK_TIMEOUT
+        self.old_lock_wait = settings.DBTEMPLATES_CACHE_LOCK_WAIT
+        self.old_jitter = settings.DBTEMPLATES_CACHE_TIMEOUT_JITTER
+        cache.clear()
+
+    def tearDown(self):
+        settings.DBTEMPLATES_CACHE_LOCK_TIMEOUT = self.old_lock_timeout
+        settings.DBTEMPLATES_CACHE_LOCK_WAIT = self.old_lock_wait
+        settings.DBTEMPLATES_CACHE_TIMEOUT_JITTER = self.old_jitter
+        cache.clear()
+
+    def test_threads_wait_for_each_other(self):
+        results = []
+
+        def load():
+            with template_lock('base.html', 1) as waited:
+                results.append(waited)
+
+        with template_lock('base.html', 1) as waited:
+            self.assertFalse(waited)
+            thread = threading.Thread(target=load)
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual(results, [])
+        thread.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(template_locks.locks, {})
+
+    def test_processes_wait_for_each_other(self):
+        settings.DBTEMPLATES_CACHE_LOCK_TIMEOUT = 10
+        settings.DBTEMPLATES_CACHE_LOCK_WAIT = 0.1
+        lock_key = lock_key_format.format(
+            site_id=1, template_name=hash_template_name('base.html'))
+        with template_lock('base.html', 1) as waited:
+            self.assertFalse(waited)
+            self.assertEqual(cache.get(lock_key), 1)
+        self.assertEqual(cache.get(lock_key), None)
+
+        cache.add(lock_key, 1)
+        with template_lock('base.html', 1) as waited:
+            self.assertTrue(waited)
+
+    def test_timeout_jitter(self):
+        timeout = settings.DBTEMPLATES_CACHE_TIMEOUT
+        settings.DBTEMPLATES_CACHE_TIMEOUT_JITTER = 0
+        self.assertEqual(get_cache_timeout(), timeout)
+        settings.DBTEMPLATES_CACHE_TIMEOUT_JITTER = 0.1
+        for i in range(10):
+            self.assertTrue(timeout <= get_cache_timeout() <= timeout * 1.1)
+
+
+class StaleWhileRevalidateTestCase(TestCase):
+    def setUp(self):
+        self.old_soft_timeout = settings.DBTEMPLATES_CACHE_SOFT_TIMEOUT
+        self.old_workers = settings.DBTEMPLATES_REFRESH_WORKERS
+        self.old_queue_size = settings.DBTEMPLATES_REFRESH_QUEUE_SIZE
+        settings.DBTEMPLATES_CACHE_SOFT_TIMEOUT = 60
+        self.site = Site.objects.get_current()
+        self.loader = Loader(Engine.get_default())
+        cache.clear()
+
+    def tearDown(self):
+        settings.DBTEMPLATES_CACHE_SOFT_TIMEOUT = self.old_soft_timeout
+        settings.DBTEMPLATES_REFRESH_WORKERS = self.old_workers
+        settings.DBTEMPLATES_REFRESH_QUEUE_SIZE = self.old_queue_size
+        cache.clear()
+
+    def test_stale_content_is_served_and_refreshed(self):
+        # refresh right away, the test database isn't shared with threads
+        settings.DBTEMPLATES_REFRESH_WORKERS = 0
+        template = Template.objects.create(name='base.html', content='base')
+        key = get_cache_key('base.html', self.site.pk)
+        self.assertEqual(cache.get(key)[0], 'base')
+        Template.objects.filter(pk=template.pk).update(content='changed')
+        with self.assertNumQueries(0):
+            self.loader.load_template_source('base.html')
+        cache.set(key, ('base', 0, None))
+        source, _ = self.loader.load_template_source('base.html')
+        self.assertEqual(source, 'base')
+        source, _ = self.loader.load_template_source('base.html')
+        self.assertEqual(source, 'changed')
+
+    def test_inline_refresh_keeps_connection_in_transaction(self):
+        settings.DBTEMPLATES_REFRESH_WORKERS = 0
+        Template.objects.create(name='base.html', content='base')
+        cache.set(get_cache_key('base.html', self.site.pk),
+                  ('base', 0, None))
+        closed = []
+        # in-memory SQLite connections are never really closed
+        connection.close = lambda: closed.append(True)
+        self.addCleanup(delattr, connection, 'close')
+        with transaction.atomic():
+            self.loader.load_template_source('base.html')
+            self.assertEqual(closed, [])
+            self.assertFalse(connection.closed_in_transaction)
+            self.assertEqual(Template.objects.count(), 1)
+
+    def test_refreshes_are_deduplicated_and_bounded(self):
+        settings.DBTEMPLATES_REFRESH_WORKERS = 1
+        settings.DBTEMPLATES_REFRESH_QUEUE_SIZE = 1
+        pool = RefreshPool()
+        started, release = threading.Event(), threading.Event()
+
+        def refresh():
+            started.set()
+            release.wait()
+
+        self.assertTrue(pool.submit('a', refresh))
+        started.wait()
+        self.assertFalse(pool.submit('a', refresh))
+        self.assertTrue(pool.submit('b', refresh))
+        self.assertFalse(pool.submit('c', refresh))
+        release.set()
+
+
+class TemplateSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.old_interval = settings.DBTEMPLATES_SNAPSHOT_POLL_INTERVAL
+        self.old_snapshot = settings.DBTEMPLATES_SNAPSHOT
+        settings.DBTEMPLATES_SNAPSHOT_POLL_INTERVAL = 60
+        # templates are only touched when their sites change if enabled
+        settings.DBTEMPLATES_SNAPSHOT = True
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='example.org',
+                                              name='example.org')
+        self.template = Template.objects.create(name='base.html',
+                                                content='base')
+        self.snapshot = TemplateSnapshot()
+        self.snapshot.load()
+
+    def tearDown(self):
+        settings.DBTEMPLATES_SNAPSHOT_POLL_INTERVAL = self.old_interval
+        settings.DBTEMPLATES_SNAPSHOT = self.old_snapshot
+
+    def test_lookups_dont_query(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.snapshot.get('base.html', self.site.pk),
+                             'base')
+            self.assertEqual(
+                self.snapshot.get('base.html', self.other_site.pk), None)
+            self.assertEqual(
+                self.snapshot.get('missing.html', self.site.pk), None)
+
+    def test_unchanged_poll_is_a_single_query(self):
+        settings.DBTEMPLATES_SNAPSHOT_POLL_INTERVAL = 0
+        with self.assertNumQueries(1):
+            self.snapshot.get('base.html', self.site.pk)
+
+    def test_poll_picks_up_changes(self):
+        settings.DBTEMPLATES_SNAPSHOT_POLL_INTERVAL = 0
+        Template.objects.create(name='new.html', content='new')
+        self.template.name = 'renamed.html'
+        self.template.save()
+        self.assertEqual(self.snapshot.get('new.html', self.site.pk), 'new')
+        self.assertEqual(self.snapshot.get('base.html', self.site.pk), None)
+        self.assertEqual(self.snapshot.get('renamed.html', self.site.pk),
+                         'base')
+
+        self.template.sites.add(self.other_site)
+        self.assertEqual(
+            self.snapshot.get('renamed.html', self.other_site.pk), 'base')
+        self.template.sites.clear()
+        self.assertEqual(
+            self.snapshot.get('renamed.html', self.other_site.pk), 'base')
+
+        self.template.delete()
+        self.assertEqual(self.snapshot.get('renamed.html', self.site.pk),
+                         None)
+
+    def fail_polls(self, snapshot):
+        def update(full):
+            snapshot.checked = time.time()
+            raise DatabaseError('unavailable')
+        snapshot.update = update
+
+    def test_failed_poll_keeps_index(self):
+        settings.DBTEMPLATES_SNAPSHOT_POLL_INTERVAL = 0
+        self.fail_polls(self.snapshot)
+        self.assertEqual(self.snapshot.get('base.html', self.site.pk),
+                         'base')
+
+    def test_failed_first_load_raises(self):
+        snapshot = TemplateSnapshot()
+        self.fail_polls(snapshot)
+        self.assertRaises(DatabaseError, snapshot.get, 'base.html',
+                          self.site.pk)
+
+    def test_loader(self):
+        loader = Loader(Engine.get_default())
+        source, name = loader.load_template_source('base.html')
+        self.assertEqual(source, 'base')
+        self.assertTrue(name.startswith('dbtemplates:snapshot:'))
+
+
+class CacheCompressionTestCase(TestCase):
+    def setUp(self):
+        self.old_min_size = settings.DBTEMPLATES_CACHE_COMPRESS_MIN_SIZE
+        self.old_chunk_size = settings.DBTEMPLATES_CACHE_CHUNK_SIZE
+        self.site = Site.objects.get_current()
+        self.loader = Loader(Engine.get_default())
+        self.content = u'{%% block content %%}\u00e9%s{%% endblock %%}' % (
+            'x' * 1000)
+        cache.clear()
+
+    def tearDown(self):
+        settings.DBTEMPLATES_CACHE_COMPRESS_MIN_SIZE = self.old_min_size
+        settings.DBTEMPLATES_CACHE_CHUNK_SIZE = self.old_chunk_size
+        cache.clear()
+
+    def load(self):
+        with self.assertNumQueries(0):
+            return self.loader.load_template_source('large.html')[0]
+
+    def test_compression(self):
+        settings.DBTEMPLATES_CACHE_COMPRESS_MIN_SIZE = 100
+        saved = cache_stats['compressed_bytes_saved']
+        Template.objects.create(name='large.html', content=self.content)
+        Template.objects.create(name='small.html', content='small')
+        self.assertEqual(
+            cache.get(get_cache_key('large.html', self.site.pk))[2], 'zlib')
+        self.assertEqual(
+            cache.get(get_cache_key('small.html', self.site.pk)), 'small')
+        self.assertTrue(cache_stats['compressed_bytes_saved'] > saved + 900)
+        self.assertEqual(self.load(), self.content)
+
+    def test_chunking(self):
+        settings.DBTEMPLATES_CACHE_CHUNK_SIZE = 100
+        Template.objects.create(name='large.html', content=self.content)
+        digest, count, encoding = cache.get(
+            get_cache_key('large.html', self.site.pk))[0]
+        self.assertEqual((count, encoding), (11, 'utf-8'))
+        self.assertEqual(self.load(), self.content)
+
+    def test_compression_and_chunking(self):
+        settings.DBTEMPLATES_CACHE_COMPRESS_MIN_SIZE = 100
+        settings.DBTEMPLATES_CACHE_CHUNK_SIZE = 10
+        Template.objects.create(name='large.html', content=self.content)
+        digest, count, encoding = cache.get(
+            get_cache_key('large.html', self.site.pk))[0]
+        self.assertEqual(encoding, 'zlib')
+        self.assertEqual(self.load(), self.content)
+
+    def test_corrupt_chunks_are_a_miss(self):
+        settings.DBTEMPLATES_CACHE_CHUNK_SIZE = 100
+        Template.objects.create(name='large.html', content=self.content)
+        digest, count, encoding = cache.get(
+            get_cache_key('large.html', self.site.pk))[0]
+        cache.set(chunk_key_format.format(digest=digest, index=1), b'x')
+        with self.assertNumQueries(1):
+            source, _ = self.loader.load_template_source('large.html')
+        self.assertEqual(source, self.content)
+
 
 class TemplateModelNameCleanTests(TestCase):
 
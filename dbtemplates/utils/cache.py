@@ -1,44 +1,662 @@
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.contrib.sites.models import Site
 from django.core.cache import caches
+from django.db import close_old_connections
+from django.template import TemplateDoesNotExist
 from django.template.defaultfilters import slugify
+from django.utils.encoding import force_bytes
+from django.utils.six.moves import queue
 from dbtemplates.conf import settings
+from dbtemplates.utils import stats
+
+logger = logging.getLogger('dbtemplates')
 
 
 def get_cache_backend():
     return caches[settings.DBTEMPLATES_CACHE_BACKEND]
 
 cache = get_cache_backend()
-key_format = 'dbtemplates::{template_name}'
+key_format = 'dbtemplates::v2::{generation}::{site_id}::{template_name}'
+legacy_key_format = 'dbtemplates::{template_name}'
+missing_key_format = ('dbtemplates::missing::{generation}::{site_id}::'
+                      '{template_name}')
+version_key = 'dbtemplates::version'
+generation_key_format = 'dbtemplates::generation::{scope}'
+lock_key_format = 'dbtemplates::lock::{site_id}::{template_name}'
+chunk_key_format = 'dbtemplates::chunk::{digest}::{index}'
+
+
+class LocalCache(object):
+    """
+    A bounded, thread-safe in-process LRU cache in front of the cache backend.
+
+    Entries are evicted in least recently used order once their total size
+    exceeds DBTEMPLATES_LOCAL_CACHE_SIZE bytes. The cache stays coherent with
+    other processes by comparing a version number, bumped in the cache
+    backend on every template change, at most every
+    DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL seconds and dropping all entries
+    once it changed.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.checked = None
+
+    @property
+    def enabled(self):
+        return settings.DBTEMPLATES_LOCAL_CACHE_SIZE > 0
+
+    def validate(self):
+        now = time.time()
+        interval = settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL
+        if self.checked is not None and now - self.checked < interval:
+            return
+        version = cache.get(version_key)
+        with self.lock:
+            self.checked = now
+            if version != self.version:
+                self._clear()
+                self.version = version
+
+    def get(self, key):
+        self.validate()
+        with self.lock:
+            try:
+                value, size, expires = self.entries.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                self.size -= size
+                return None
+            self.entries[key] = value, size, expires
+            return value
+
+    def set(self, key, value, size, version, timeout=None):
+        """
+        Stores the value unless the version changed since ``version`` was
+        read, i.e. the value might have been fetched before a change, for
+        at most ``timeout`` seconds if given.
+        """
+        max_size = settings.DBTEMPLATES_LOCAL_CACHE_SIZE
+        if size > max_size:
+            return
+        expires = time.time() + timeout if timeout is not None else None
+        with self.lock:
+            if version != self.version:
+                return
+            self._delete(key)
+            self.entries[key] = value, size, expires
+            self.size += size
+            while self.size > max_size:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _delete(self, key):
+        try:
+            _, size, _ = self.entries.pop(key)
+        except KeyError:
+            pass
+        else:
+            self.size -= size
+
+    def _clear(self):
+        self.entries.clear()
+        self.size = 0
+
+local_cache = LocalCache()
+# stored in the local cache for keys the cache backend didn't have
+absent = object()
+compiled_template_caches = weakref.WeakSet()
+generations = {}
+prefetched = threading.local()
+cache_stats = {
+    'compressed': 0,
+    'compressed_bytes_saved': 0,
+    'chunked': 0,
+    'corrupt': 0,
+}
+
+
+def get_prefetched_templates():
+    """
+    Returns the dict of the templates prefetched by the current thread,
+    mapping site ids and template names to the content, or None if the
+    template doesn't exist in the database, and the time it expires.
+    """
+    try:
+        return prefetched.templates
+    except AttributeError:
+        prefetched.templates = {}
+        return prefetched.templates
+
+
+def bump_cache_version():
+    """
+    Tells the local and compiled template caches of all processes that
+    templates have changed.
+    """
+    get_prefetched_templates().clear()
+    if not cache:
+        return
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        if not cache.add(version_key, 1, None):
+            cache.incr(version_key)
+
+
+class KeyLocks(object):
+    """
+    Hands out a lock per key, kept only while it's held or waited for.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextmanager
+    def __call__(self, key):
+        """
+        Holds the lock of the given key, yielding whether it had to wait
+        for another thread to release it.
+        """
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            waited = not entry[0].acquire(False)
+            if waited:
+                entry[0].acquire()
+            try:
+                yield waited
+            finally:
+                entry[0].release()
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+template_locks = KeyLocks()
+
+
+class RefreshPool(object):
+    """
+    A small pool of daemon threads refreshing soft-expired templates in
+    the background, see DBTEMPLATES_CACHE_SOFT_TIMEOUT.
+
+    At most DBTEMPLATES_REFRESH_QUEUE_SIZE refreshes are queued and only one
+    per key at a time; further refreshes are dropped. Without any
+    DBTEMPLATES_REFRESH_WORKERS, templates are refreshed right away.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.queue = None
+        self.pid = None
+
+    def submit(self, key, refresh):
+        """
+        Schedules the refresh callable for the given key, returning whether
+        it was scheduled.
+        """
+        if not settings.DBTEMPLATES_REFRESH_WORKERS:
+            self.run(refresh)
+            return True
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.start()
+            try:
+                self.queue.put_nowait((key, refresh))
+            except queue.Full:
+                return False
+            self.pending.add(key)
+        return True
 
+    def start(self):
+        # threads don't survive forking, e.g. by gunicorn
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.pending.clear()
+        self.queue = queue.Queue(settings.DBTEMPLATES_REFRESH_QUEUE_SIZE)
+        for i in range(settings.DBTEMPLATES_REFRESH_WORKERS):
+            thread = threading.Thread(target=self.work, args=(self.queue,),
+                                      name='dbtemplates-refresh-%d' % i)
+            thread.daemon = True
+            thread.start()
 
-def get_cache_key(template_name):
+    def work(self, refresh_queue):
+        while True:
+            key, refresh = refresh_queue.get()
+            try:
+                self.run(refresh)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                # only the worker's own connections, the ones of a request
+                # refreshing inline may be in a transaction
+                close_old_connections()
+
+    def run(self, refresh):
+        try:
+            refresh()
+        except Exception:
+            logger.exception("Refreshing a cached template failed.")
+
+refresh_pool = RefreshPool()
+
+
+def hash_template_name(template_name):
+    return hashlib.md5(force_bytes(template_name)).hexdigest()
+
+
+def get_generation_key(site_id=None):
+    return generation_key_format.format(
+        scope='global' if site_id is None else site_id
+    )
+
+
+def get_generations(site_ids):
+    """
+    Returns a dict mapping the given site ids, or None for templates without
+    any sites, to the namespace generation folded into their cache keys.
+
+    The generations are read from the cache backend with a single call at
+    most every DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL seconds.
+    """
+    now = time.time()
+    interval = settings.DBTEMPLATES_LOCAL_CACHE_CHECK_INTERVAL
+    global_key = get_generation_key()
+    keys = dict((site_id, get_generation_key(site_id))
+                for site_id in site_ids if site_id is not None)
+    stale = [key for key in set(keys.values()) | set([global_key])
+             if key not in generations or
+             now - generations[key][1] >= interval]
+    if stale:
+        values = cache.get_many(stale)
+        for key in stale:
+            value = values.get(key)
+            if value is None:
+                value = init_generation(key)
+            generations[key] = value, now
+    global_generation = generations[global_key][0]
+    result = dict((site_id, '%s.%s' % (global_generation, generations[key][0]))
+                  for site_id, key in keys.items())
+    if None in site_ids:
+        result[None] = '%s' % global_generation
+    return result
+
+
+def init_generation(key):
+    """
+    Starts a generation counter at the current time, so that it doesn't
+    repeat an earlier generation if the counter was evicted from the cache.
+    """
+    value = int(time.time())
+    if key in generations and value <= generations[key][0]:
+        value = generations[key][0] + 1
+    if not cache.add(key, value, None):
+        value = cache.get(key, value)
+    return value
+
+
+def invalidate_cached_templates(site_id=None):
+    """
+    Makes all cached templates stale at once by incrementing the namespace
+    generation of the given site, or the global one if ``site_id`` is None.
+    Templates without any sites are only affected by the global generation.
+    """
+    key = get_generation_key(site_id)
+    try:
+        value = cache.incr(key)
+    except ValueError:
+        value = init_generation(key)
+    generations[key] = value, time.time()
+    bump_cache_version()
+
+
+def get_cache_key(template_name, site_id=None):
+    """
+    Returns the cache key of a template on the given site, or of a template
+    without any sites if ``site_id`` is None. The template name is hashed,
+    so different names never share a key.
+    """
     return key_format.format(
+        generation=get_generations([site_id])[site_id],
+        site_id='*' if site_id is None else site_id,
+        template_name=hash_template_name(template_name)
+    )
+
+
+def get_legacy_cache_key(template_name):
+    """
+    Returns the cache key used for the template before version 2 of the key
+    scheme, see ``remove_legacy_cached_templates``.
+    """
+    return legacy_key_format.format(
         template_name=slugify(template_name)
     )
 
 
-def fetch_template_from_cache(template_name, satisfies_permissions):
-    """Returns a template_name from the cache conditionaly."""
-    if cache:
-        key = get_cache_key(template_name)
-        cache_value = cache.get(key)
-        if satisfies_permissions(cache_value):
-            return cache_value.get('content')
+def get_missing_cache_key(template_name, site_id):
+    return missing_key_format.format(
+        generation=get_generations([site_id])[site_id],
+        site_id=site_id,
+        template_name=hash_template_name(template_name)
+    )
+
+
+def fetch_template_from_cache(template_name, site_id, refresh=None):
+    """
+    Returns the cached content of the template for the given site, or None.
+    Raises TemplateDoesNotExist if the template is known to be missing from
+    the database, see DBTEMPLATES_NEGATIVE_CACHE.
+
+    If the content is soft-expired, it's returned nonetheless and the given
+    ``refresh`` callable is scheduled to run in the background.
+    """
+    contents, missing = fetch_templates_from_cache(
+        [template_name], site_id, refresh and (lambda name: refresh))
+    if template_name in missing:
+        raise TemplateDoesNotExist(template_name)
+    return contents.get(template_name)
+
+
+def fetch_templates_from_cache(template_names, site_id, refresh=None):
+    """
+    Returns a dict of the cached contents of the given templates for the
+    given site and a set of the names known to be missing from the
+    database, with a single cache call.
+
+    ``refresh`` is called with the name of each soft-expired template to
+    get the callable to run in the background.
+    """
+    if not cache:
+        return {}, set()
+    negative = settings.DBTEMPLATES_NEGATIVE_CACHE
+    keys = {}
+    for name in template_names:
+        keys[name] = (get_cache_key(name, site_id), get_cache_key(name),
+                      get_missing_cache_key(name, site_id) if negative
+                      else None)
+    local_keys = set()
+    values = get_cached_values(
+        keys.values(), local_keys,
+        [missing_key for site_key, siteless_key, missing_key in keys.values()
+         if missing_key is not None])
+    contents, missing = {}, set()
+    for name, (site_key, siteless_key, missing_key) in keys.items():
+        for key in (site_key, siteless_key):
+            if key in values:
+                content, stale = unpack_template(values[key])
+                if stale and refresh is not None:
+                    refresh_pool.submit(key, refresh(name))
+                    stats.incr('cache_stale_hits', site_id, name)
+                contents[name] = content
+                stats.incr('local_cache_hits' if key in local_keys
+                           else 'cache_hits', site_id, name)
+                break
+        else:
+            if missing_key is not None and values.get(missing_key):
+                missing.add(name)
+                stats.incr('negative_cache_hits', site_id, name)
+            else:
+                stats.incr('cache_misses', site_id, name)
+    return contents, missing
+
+
+def pack_template(content):
+    """
+    Returns the value to cache for the given template content and a dict
+    of the chunks to cache along with it, if any.
+
+    The content is compressed if it's at least
+    DBTEMPLATES_CACHE_COMPRESS_MIN_SIZE bytes long, and split into chunks
+    stored under their own keys if it's longer than
+    DBTEMPLATES_CACHE_CHUNK_SIZE bytes. It's stored along with its soft
+    expiry time if DBTEMPLATES_CACHE_SOFT_TIMEOUT is set.
+    """
+    data, encoding, chunks = content, None, {}
+    min_size = settings.DBTEMPLATES_CACHE_COMPRESS_MIN_SIZE
+    chunk_size = settings.DBTEMPLATES_CACHE_CHUNK_SIZE
+    if min_size or chunk_size:
+        raw = force_bytes(content)
+        if min_size and len(raw) >= min_size:
+            compressed = zlib.compress(raw)
+            if len(compressed) < len(raw):
+                cache_stats['compressed'] += 1
+                cache_stats['compressed_bytes_saved'] += \
+                    len(raw) - len(compressed)
+                data, encoding = compressed, 'zlib'
+        if chunk_size and len(raw if encoding is None else data) > chunk_size:
+            blob = raw if encoding is None else data
+            digest = hashlib.md5(blob).hexdigest()
+            for index in range(0, len(blob), chunk_size):
+                chunk_key = chunk_key_format.format(digest=digest,
+                                                    index=index // chunk_size)
+                chunks[chunk_key] = blob[index:index + chunk_size]
+            cache_stats['chunked'] += 1
+            data = digest, len(chunks), encoding or 'utf-8'
+            encoding = 'chunks'
+    soft_timeout = settings.DBTEMPLATES_CACHE_SOFT_TIMEOUT
+    soft_expires = time.time() + soft_timeout if soft_timeout else None
+    if encoding is None and soft_expires is None:
+        return content, chunks
+    return (data, soft_expires, encoding), chunks
+
+
+def decode_values(values):
+    """
+    Returns the given cached values with packed templates decompressed and
+    reassembled from their chunks, using a single cache call for all chunks.
+    Templates whose chunks are missing or corrupt are left out.
+    """
+    chunk_keys = []
+    for value in values.values():
+        if isinstance(value, tuple) and value[2] == 'chunks':
+            digest, count, encoding = value[0]
+            chunk_keys.extend(chunk_key_format.format(digest=digest,
+                                                      index=index)
+                              for index in range(count))
+    chunks = cache.get_many(chunk_keys) if chunk_keys else {}
+    decoded = {}
+    for key, value in values.items():
+        if isinstance(value, tuple):
+            data, soft_expires, encoding = value
+            if encoding == 'chunks':
+                digest, count, encoding = data
+                data = b''.join(chunks.get(chunk_key_format.format(
+                    digest=digest, index=index), b'') for index in range(count))
+                if hashlib.md5(data).hexdigest() != digest:
+                    cache_stats['corrupt'] += 1
+                    continue
+            if encoding == 'zlib':
+                data = zlib.decompress(data)
+            if encoding is not None:
+                data = data.decode('utf-8')
+            value = data if soft_expires is None else (data, soft_expires)
+        decoded[key] = value
+    return decoded
+
+
+def unpack_template(value):
+    """
+    Returns the template content of a decoded cached value and whether it's
+    soft-expired.
+    """
+    if isinstance(value, tuple):
+        content, soft_expires = value
+        return content, soft_expires < time.time()
+    return value, False
+
+
+def get_cached_values(key_groups, local_keys=None, negative_keys=()):
+    """
+    Returns a dict of the decoded values of the given groups of keys, each
+    in order of priority, e.g. the keys of a template for its site, for all
+    sites and in the negative cache. Keys after the first one found in a
+    group aren't needed.
+
+    If the local cache is enabled, the keys of each group are looked up in
+    it first, where keys the cache backend didn't have are remembered too,
+    and the cache backend is only asked for the groups it couldn't answer.
+    The keys found in the local cache are added to the ``local_keys`` set,
+    if given. The given ``negative_keys`` are kept in the local cache for
+    at most DBTEMPLATES_NEGATIVE_CACHE_TIMEOUT seconds, like in the cache
+    backend.
+    """
+    key_groups = [[key for key in keys if key is not None]
+                  for keys in key_groups]
+    if not local_cache.enabled:
+        return decode_values(cache.get_many(
+            [key for keys in key_groups for key in keys]))
+    values, missing_keys = {}, []
+    for keys in key_groups:
+        for index, key in enumerate(keys):
+            value = local_cache.get(key)
+            if value is None:
+                missing_keys.extend(keys[index:])
+                break
+            if value is not absent:
+                values[key] = value
+                if local_keys is not None:
+                    local_keys.add(key)
+                break
+    if missing_keys:
+        version = local_cache.version
+        negative_keys = set(negative_keys)
+        negative_timeout = settings.DBTEMPLATES_NEGATIVE_CACHE_TIMEOUT
+        fetched = decode_values(cache.get_many(missing_keys))
+        for key in missing_keys:
+            timeout = negative_timeout if key in negative_keys else None
+            if key in fetched:
+                size = len(force_bytes(unpack_template(fetched[key])[0]))
+                local_cache.set(key, fetched[key], size, version, timeout)
+            else:
+                local_cache.set(key, absent, len(key), version, timeout)
+        values.update(fetched)
+    return values
+
+
+def get_cache_timeout():
+    """
+    Returns DBTEMPLATES_CACHE_TIMEOUT, extended by a random share of up to
+    DBTEMPLATES_CACHE_TIMEOUT_JITTER of it, so that templates cached at the
+    same time don't all expire at once.
+    """
+    timeout = settings.DBTEMPLATES_CACHE_TIMEOUT
+    jitter = settings.DBTEMPLATES_CACHE_TIMEOUT_JITTER
+    if timeout and jitter:
+        timeout += timeout * jitter * random.random()
+    return timeout
+
+
+@contextmanager
+def template_lock(template_name, site_id):
+    """
+    Makes sure only one thread of this process, and if
+    DBTEMPLATES_CACHE_LOCK_TIMEOUT is set only one process, loads a missing
+    template from the database at a time.
+
+    Yields whether it waited for another thread or process, in which case
+    the template is likely cached by now. Other processes are waited for at
+    most DBTEMPLATES_CACHE_LOCK_WAIT seconds.
+    """
+    with template_locks((template_name, site_id)) as waited:
+        lock_timeout = settings.DBTEMPLATES_CACHE_LOCK_TIMEOUT
+        if not lock_timeout or not cache:
+            yield waited
+            return
+        lock_key = lock_key_format.format(
+            site_id=site_id, template_name=hash_template_name(template_name))
+        if cache.add(lock_key, 1, lock_timeout):
+            try:
+                yield waited
+            finally:
+                cache.delete(lock_key)
+            return
+        deadline = time.time() + settings.DBTEMPLATES_CACHE_LOCK_WAIT
+        while time.time() < deadline and cache.get(lock_key) is not None:
+            time.sleep(0.05)
+        yield True
 
 
 def add_template_to_cache(instance, **kwargs):
     """
     Called via Django's signals to cache the templates, if the template
-    in the database was added or changed.
-    """
-    remove_cached_template(instance)
-    key = get_cache_key(instance.name)
-    value = {
-        'content': instance.content,
-        'sites':  set(instance.sites.values_list('pk', flat=True))
-    }
-    if cache:
-        cache_timeout = getattr(settings, 'DBTEMPLATES_CACHE_TIMEOUT')
-        cache.set(key, value, cache_timeout)
+    in the database was added or changed. Its negative cache entries are
+    dropped, and other processes are told about the change once all of
+    that is done, so they can't see the template as missing.
+    """
+    sites = set(instance.sites.values_list('pk', flat=True))
+    remove_cached_templates([instance.name], bump_version=False)
+    set_cached_template(instance.name, instance.content, sites)
+    remove_missing_templates_from_cache([instance.name])
+    bump_cache_version()
+
+
+def set_cached_template(template_name, content, sites):
+    """
+    Caches the content of a template for each of the given site ids, or
+    for all sites if it has none.
+    """
+    if not cache:
+        return
+    get_generations(list(sites))
+    keys = [get_cache_key(template_name, site_id) for site_id in sites]
+    if not keys:
+        keys = [get_cache_key(template_name)]
+    value, chunks = pack_template(content)
+    values = dict.fromkeys(keys, value)
+    values.update(chunks)
+    cache.set_many(values, get_cache_timeout())
+    for key in keys:
+        local_cache.delete(key)
+
+
+def add_templates_to_cache(templates):
+    """
+    Caches the given (name, content, site ids) tuples with a single
+    cache write.
+    """
+    if not cache:
+        return
+    values = {}
+    templates = list(templates)
+    get_generations(set(site_id for template_name, content, sites in templates
+                        for site_id in sites or [None]))
+    keys = []
+    for template_name, content, sites in templates:
+        value, chunks = pack_template(content)
+        values.update(chunks)
+        for site_id in sites or [None]:
+            key = get_cache_key(template_name, site_id)
+            values[key] = value
+            keys.append(key)
+    cache.set_many(values, get_cache_timeout())
+    for key in keys:
+        local_cache.delete(key)
 
 
 def remove_cached_template(instance, **kwargs):
@@ -46,4 +664,93 @@ def remove_cached_template(instance, **kwargs):
     Called via Django's signals to remove cached templates, if the template
     in the database was changed or deleted.
     """
-    cache.delete(get_cache_key(instance.name))
+    remove_cached_templates([instance.name])
+
+
+def remove_cached_templates(template_names, bump_version=True):
+    """
+    Removes the given templates from the cache for all sites with a single
+    cache call. Unless ``bump_version`` is False, e.g. because the templates
+    are cached again right after, other processes are told about it.
+    """
+    site_ids = list(Site.objects.values_list('pk', flat=True)) + [None]
+    get_generations(site_ids)
+    keys = [get_cache_key(name, site_id)
+            for name in template_names for site_id in site_ids]
+    if keys:
+        cache.delete_many(keys)
+    for key in keys:
+        local_cache.delete(key)
+    if bump_version:
+        bump_cache_version()
+
+
+def remove_legacy_cached_templates(template_names):
+    """
+    Removes the entries of the given templates cached with the legacy,
+    slugified cache keys.
+    """
+    if cache:
+        cache.delete_many([get_legacy_cache_key(name)
+                           for name in template_names])
+
+
+def add_missing_template_to_cache(template_name, site_id):
+    """
+    Remembers that the template doesn't exist in the database for the given
+    site, for DBTEMPLATES_NEGATIVE_CACHE_TIMEOUT seconds.
+    """
+    add_missing_templates_to_cache([template_name], site_id)
+
+
+def add_missing_templates_to_cache(template_names, site_id):
+    template_names = list(template_names)
+    if (not settings.DBTEMPLATES_NEGATIVE_CACHE or not cache or
+            not template_names):
+        return
+    cache_timeout = getattr(settings, 'DBTEMPLATES_NEGATIVE_CACHE_TIMEOUT')
+    keys = [get_missing_cache_key(name, site_id) for name in template_names]
+    cache.set_many(dict.fromkeys(keys, True), cache_timeout)
+    for key in keys:
+        local_cache.delete(key)
+
+
+def remove_missing_templates_from_cache(template_names, site_ids=None):
+    """
+    Forgets the negative cache entries of the given template names, for
+    the given sites or for all sites if ``site_ids`` is None.
+    """
+    if not settings.DBTEMPLATES_NEGATIVE_CACHE or not cache:
+        return
+    if site_ids is None:
+        site_ids = Site.objects.values_list('pk', flat=True)
+    site_ids = list(site_ids)
+    get_generations(site_ids)
+    keys = [get_missing_cache_key(name, site_id)
+            for name in template_names for site_id in site_ids]
+    cache.delete_many(keys)
+    for key in keys:
+        local_cache.delete(key)
+
+
+def remove_missing_template_from_cache(instance, **kwargs):
+    """
+    Called via Django's signals to remove the negative cache entries of
+    a template, if the template in the database was added or changed.
+    """
+    remove_missing_templates_from_cache([instance.name])
+
+
+def remove_compiled_template(instance, **kwargs):
+    """
+    Called via Django's signals to drop compiled templates from the
+    template caches of this process, if the template in the database was
+    changed or deleted.
+    """
+    remove_compiled_templates([instance.name])
+
+
+def remove_compiled_templates(template_names):
+    for compiled_cache in list(compiled_template_caches):
+        for name in template_names:
+            compiled_cache.remove_template(name)
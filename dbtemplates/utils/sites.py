@@ -0,0 +1,54 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.sites.models import Site, SITE_CACHE
+
+current = threading.local()
+
+
+def get_current_site_id():
+    """
+    Returns the id of the site set for the current thread, e.g. by
+    ``dbtemplates.middleware.CurrentSiteMiddleware``, or else SITE_ID,
+    without looking up the site itself.
+    """
+    site_id = getattr(current, 'site_id', None)
+    if site_id is None:
+        site_id = getattr(settings, 'SITE_ID', None)
+    if site_id is None:
+        site_id = Site.objects.get_current().pk
+    return site_id
+
+
+def set_current_site_id(site_id):
+    current.site_id = site_id
+
+
+def clear_current_site_id():
+    current.site_id = None
+
+
+@contextmanager
+def current_site_id(site_id):
+    """
+    Makes the template loader use the site with the given id in the current
+    thread, e.g. in tasks rendering the templates of several sites.
+    """
+    old_site_id = getattr(current, 'site_id', None)
+    set_current_site_id(site_id)
+    try:
+        yield
+    finally:
+        set_current_site_id(old_site_id)
+
+
+def get_site_domain(site_id):
+    """
+    Returns the domain of the site with the given id, sharing Django's cache
+    of the current sites.
+    """
+    site = SITE_CACHE.get(site_id)
+    if site is None:
+        site = SITE_CACHE[site_id] = Site.objects.get(pk=site_id)
+    return site.domain
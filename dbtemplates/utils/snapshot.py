@@ -0,0 +1,118 @@
+import datetime
+import logging
+import threading
+import time
+
+from django.db import DatabaseError, connections
+from django.db.models import Count, Max
+
+from dbtemplates.conf import settings
+from dbtemplates.models import Template, get_template_sites
+
+logger = logging.getLogger('dbtemplates')
+
+
+class TemplateSnapshot(object):
+    """
+    An in-process index of all templates in the database and their sites,
+    see DBTEMPLATES_SNAPSHOT.
+
+    The index is never changed in place but replaced as a whole, so readers
+    don't need any locking. It's refreshed at most every
+    DBTEMPLATES_SNAPSHOT_POLL_INTERVAL seconds, by comparing the latest
+    ``last_changed`` value and the number of templates with the database and
+    re-reading only the templates changed since the last refresh. If that
+    fails, e.g. while the database is unavailable, the old index is kept
+    until the next poll.
+    """
+    # re-read templates changed a bit before the latest known change, in
+    # case they were committed late
+    overlap = datetime.timedelta(seconds=60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.templates = None
+        self.state = None
+        self.checked = None
+
+    def get(self, template_name, site_id):
+        """
+        Returns the content of the template available on the given site,
+        or None.
+        """
+        now = time.time()
+        interval = settings.DBTEMPLATES_SNAPSHOT_POLL_INTERVAL
+        if self.checked is None or now - self.checked >= interval:
+            self.refresh()
+        template = self.templates.get(template_name)
+        if template is None:
+            return None
+        pk, content, sites = template
+        if sites and site_id not in sites:
+            return None
+        return content
+
+    def load(self):
+        """
+        Reads all templates, e.g. before the web server forks its workers.
+        """
+        with self.lock:
+            self.update(full=True)
+
+    def refresh(self):
+        # only one thread refreshes, the others keep reading the old index
+        if not self.lock.acquire(False):
+            if self.templates is not None:
+                return
+            self.lock.acquire()
+        try:
+            self.update(full=self.templates is None)
+        except DatabaseError:
+            if self.templates is None:
+                raise
+            logger.exception("Refreshing the template snapshot failed.")
+        finally:
+            self.lock.release()
+
+    def update(self, full):
+        self.checked = time.time()
+        state = Template.objects.aggregate(
+            last_changed=Max('last_changed'), count=Count('pk'))
+        state = state['last_changed'], state['count']
+        if not full and state == self.state:
+            return
+        rows = Template.objects.values_list('pk', 'name', 'content')
+        if full or self.state[0] is None:
+            templates = {}
+        else:
+            templates = dict(self.templates)
+            rows = rows.filter(
+                last_changed__gte=self.state[0] - self.overlap)
+            pks = set(Template.objects.values_list('pk', flat=True))
+            for name, template in list(templates.items()):
+                if template[0] not in pks:
+                    del templates[name]
+        rows = list(rows)
+        sites = get_template_sites([pk for pk, name, content in rows])
+        names = dict((template[0], name)
+                     for name, template in templates.items())
+        for pk, name, content in rows:
+            if pk in names:
+                del templates[names[pk]]
+            templates[name] = pk, content, frozenset(sites[pk])
+        self.templates = templates
+        self.state = state
+
+snapshot = TemplateSnapshot()
+
+
+def preload():
+    """
+    Loads the template snapshot of this process, see DBTEMPLATES_SNAPSHOT.
+
+    The database connections are closed afterwards, so that they aren't
+    shared with forked worker processes.
+    """
+    snapshot.load()
+    for connection in connections.all():
+        connection.close()
@@ -0,0 +1,209 @@
+import os
+import socket
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from dbtemplates.conf import settings
+
+stats_key_format = 'dbtemplates::stats::{process}'
+stats_index_key = 'dbtemplates::stats::index'
+# upper bounds of the timing histogram buckets, in seconds
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1, float('inf'))
+
+
+class Metrics(object):
+    """
+    Counters and timing histograms of the template loader of this process,
+    per metric, site id and, if DBTEMPLATES_METRICS_PER_TEMPLATE is enabled,
+    template name.
+
+    Every DBTEMPLATES_METRICS_PUBLISH_INTERVAL seconds they're published to
+    the cache backend for the ``template_stats`` command.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callback = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.pid = os.getpid()
+            self.process = '%s:%s' % (socket.gethostname(), self.pid)
+            self.started = time.time()
+            self.published = self.started
+            self.counters = {}
+            self.timings = {}
+
+    def get_key(self, metric, site_id, template_name):
+        if not settings.DBTEMPLATES_METRICS_PER_TEMPLATE:
+            template_name = None
+        return metric, site_id, template_name
+
+    def incr(self, metric, site_id=None, template_name=None, value=1):
+        self.check_fork()
+        key = self.get_key(metric, site_id, template_name)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.report('incr', key, value)
+
+    def timing(self, metric, seconds, site_id=None, template_name=None):
+        self.check_fork()
+        key = self.get_key(metric, site_id, template_name)
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = [0, 0.0, [0] * len(buckets)]
+            timing[0] += 1
+            timing[1] += seconds
+            for index, bound in enumerate(buckets):
+                if seconds <= bound:
+                    timing[2][index] += 1
+                    break
+        self.report('timing', key, seconds)
+
+    def check_fork(self):
+        # forked worker processes start counting from scratch
+        if os.getpid() != self.pid:
+            self.reset()
+
+    def report(self, kind, key, value):
+        callback = self.get_callback()
+        if callback is not None:
+            metric, site_id, template_name = key
+            callback(kind, metric, value, site_id, template_name)
+        interval = settings.DBTEMPLATES_METRICS_PUBLISH_INTERVAL
+        if interval and time.time() - self.published >= interval:
+            self.publish()
+
+    def get_callback(self):
+        path = settings.DBTEMPLATES_METRICS_CALLBACK
+        if not path:
+            return None
+        if self.callback is None or self.callback[0] != path:
+            try:
+                self.callback = path, import_string(path)
+            except ImportError as e:
+                raise ImproperlyConfigured(
+                    "Couldn't import DBTEMPLATES_METRICS_CALLBACK '%s': %s" %
+                    (path, e))
+        return self.callback[1]
+
+    def get_stats(self):
+        """
+        Returns the metrics of this process as a dict that can be cached.
+        """
+        from dbtemplates.utils.cache import cache_stats
+        with self.lock:
+            counters = [[metric, site_id, template_name, value]
+                        for (metric, site_id, template_name), value
+                        in self.counters.items()]
+            timings = [[metric, site_id, template_name, count, total,
+                        list(histogram)]
+                       for (metric, site_id, template_name),
+                       (count, total, histogram) in self.timings.items()]
+        counters.extend([metric, None, None, value]
+                        for metric, value in cache_stats.items() if value)
+        return {
+            'process': self.process,
+            'started': self.started,
+            'time': time.time(),
+            'counters': counters,
+            'timings': timings,
+        }
+
+    def publish(self):
+        """
+        Stores the metrics of this process in the cache backend.
+        """
+        from dbtemplates.utils.cache import cache
+        self.published = time.time()
+        if not cache:
+            return
+        interval = settings.DBTEMPLATES_METRICS_PUBLISH_INTERVAL
+        timeout = max(interval * 10, 600)
+        cache.set(stats_key_format.format(process=self.process),
+                  self.get_stats(), timeout)
+        processes = cache.get(stats_index_key) or []
+        if self.process not in processes:
+            processes = [process for process in processes if cache.get(
+                stats_key_format.format(process=process)) is not None]
+            processes.append(self.process)
+            cache.set(stats_index_key, processes, timeout)
+
+
+metrics = Metrics()
+
+
+def incr(metric, site_id=None, template_name=None, value=1):
+    """
+    Increments a counter if DBTEMPLATES_METRICS is enabled.
+    """
+    if settings.DBTEMPLATES_METRICS:
+        metrics.incr(metric, site_id, template_name, value)
+
+
+def timing(metric, seconds, site_id=None, template_name=None):
+    """
+    Records a duration if DBTEMPLATES_METRICS is enabled.
+    """
+    if settings.DBTEMPLATES_METRICS:
+        metrics.timing(metric, seconds, site_id, template_name)
+
+
+def get_stats():
+    """
+    Returns the metrics of this process.
+    """
+    return metrics.get_stats()
+
+
+def get_published_stats():
+    """
+    Returns the metrics published by all processes, including this one.
+    """
+    from dbtemplates.utils.cache import cache
+    if settings.DBTEMPLATES_METRICS:
+        metrics.publish()
+    if not cache:
+        return [get_stats()]
+    processes = cache.get(stats_index_key) or []
+    published = cache.get_many([stats_key_format.format(process=process)
+                                for process in processes])
+    return list(published.values())
+
+
+def merge_stats(stats):
+    """
+    Sums the given metrics of several processes up and returns dicts of
+    the counters and timings per metric, site id and template name.
+    """
+    counters, timings = {}, {}
+    for process_stats in stats:
+        for metric, site_id, template_name, value in process_stats['counters']:
+            key = metric, site_id, template_name
+            counters[key] = counters.get(key, 0) + value
+        for (metric, site_id, template_name, count, total,
+             histogram) in process_stats['timings']:
+            key = metric, site_id, template_name
+            merged = timings.setdefault(key, [0, 0.0, [0] * len(buckets)])
+            merged[0] += count
+            merged[1] += total
+            merged[2] = [a + b for a, b in zip(merged[2], histogram)]
+    return counters, timings
+
+
+def get_percentile(histogram, percentile):
+    """
+    Returns the upper bound of the histogram bucket of the given percentile.
+    """
+    count = sum(histogram)
+    seen = 0
+    for bound, bucket in zip(buckets, histogram):
+        seen += bucket
+        if count and seen >= count * percentile / 100.0:
+            return bound
+    return None
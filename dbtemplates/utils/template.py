@@ -1,6 +1,7 @@
 from django import VERSION
 from django.template import (
     Engine, Template, TemplateDoesNotExist, TemplateSyntaxError)
+from django.template.base import Lexer, TOKEN_BLOCK
 
 
 def get_loaders():
@@ -32,9 +33,49 @@ def get_template_source(name):
     return None
 
 
+def get_template_dependencies(content):
+    """
+    Returns the sorted ``(kind, name)`` pairs of the templates the given
+    template content extends or includes, where ``kind`` is either
+    ``'extends'`` or ``'include'``. Only names given as string literals are
+    known before rendering, so other targets are skipped.
+    """
+    if VERSION < (1, 9):
+        lexer = Lexer(content, None)
+    else:
+        lexer = Lexer(content)
+    dependencies = set()
+    for token in lexer.tokenize():
+        if token.token_type != TOKEN_BLOCK:
+            continue
+        bits = token.split_contents()
+        if len(bits) < 2 or bits[0] not in ('extends', 'include'):
+            continue
+        name = bits[1]
+        if len(name) > 2 and name[0] == name[-1] and name[0] in '"\'':
+            dependencies.add((bits[0], name[1:-1]))
+    return sorted(dependencies)
+
+
 def check_template_syntax(template):
     try:
         Template(template.content)
     except TemplateSyntaxError, e:
         return (False, e)
     return (True, None)
+
+
+def check_template_source(item):
+    """
+    Checks the syntax of the given ``(name, content)`` pair and returns the
+    name and the error message, or ``None`` if the template is valid.
+
+    Only uses picklable arguments and return values, so it can be mapped
+    over a process pool.
+    """
+    name, content = item
+    try:
+        Template(content)
+    except TemplateSyntaxError, e:
+        return name, u'%s' % e
+    return name, None
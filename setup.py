@@ -30,6 +30,7 @@ setup(
     package_data={
         'dbtemplates': [
             'locale/*/LC_MESSAGES/*',
+            'templates/admin/dbtemplates/template/*.html',
             'static/dbtemplates/css/*.css',
             'static/dbtemplates/js/*.js',
         ],